@@ -1,15 +1,21 @@
 '''
 Auxiliary functions to align peilmerk (leveling) measurements
 '''
-import statistics
 import time
-import copy
+import itertools
 import datetime
 import pandas as pd
 import numpy as np
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    from joblib import Parallel, delayed, effective_n_jobs
+except ImportError:
+    Parallel = None
 
 from . import pmexception as BE
-from . import interpolatefunctions as IF
 from . import messagelogger as ML
 
 class NoOverlapException(BE.PMException):
@@ -18,9 +24,19 @@ class NoOverlapException(BE.PMException):
     '''
     pass
 
-# Performance timing
+# Performance timing. Only done if _PROFILE is set, to keep the
+# overhead out of the normal use.
+_PROFILE=False
 times=dict()
 
+def _lap(tdict, indx, start):
+    '''
+    Add the time since 'start' to tdict[indx]. Returns the new start time.
+    '''
+    now=time.time()
+    tdict[indx]+=now-start
+    return now
+
 def RESETTIME():
     global times
     for indx in range(20):
@@ -32,6 +48,10 @@ def GETTIME():
     global times
     return times
 
+# Minimum number of peilmerken for AlignAllMedian2Level to run in
+# parallel (if joblib is available)
+PARALLEL_MIN_PMS=200
+
 # Common keys used in this module
 MERGE="merge"
 MEDIAN="median"
@@ -42,6 +62,137 @@ DZ="dz"
 # Default starting point (also for conversion of datetime<-->float)
 T0 = datetime.date(1970,1,1)
 
+def _toArr(tzPairs):
+    '''
+    Convert a tzPair list to an (N,2) float array, column 0 being t and
+    column 1 being z. Used internally, so shifts can be done in one go.
+    This packs each (t,z) pair in 16 bytes (the same layout as a
+    structured (t,z) dtype), instead of a tuple with two float objects.
+    Always returns a new array.
+    '''
+    if isinstance(tzPairs, np.ndarray):
+        return np.array(tzPairs, dtype=np.float64).reshape(-1, 2)
+
+    # Stream the values, rather than have numpy inspect each tuple
+    return np.fromiter(itertools.chain.from_iterable(tzPairs), dtype=np.float64,
+                       count=2*len(tzPairs)).reshape(-1, 2)
+
+def _toTZList(tzArr):
+    '''
+    Convert an (N,2) array (see _toArr) back to a tzPair list
+    '''
+    return list(zip(tzArr[:,0].tolist(), tzArr[:,1].tolist()))
+
+def _zAt(tzArr, t):
+    '''
+    Interpolate z at time 't' in (N,2) array 'tzArr' (see _toArr).
+    Same as interpolatefunctions.Interpolate(..., extrapol=False), but
+    without a python loop over the (numpy) elements.
+    '''
+    if (len(tzArr)==0):
+        raise IndexError("No data to interpolate")
+    return float(np.interp(t, tzArr[:,0], tzArr[:,1]))
+
+def _toArrDict(tzData):
+    '''
+    Convert dict with tzPair lists to dict with (N,2) arrays
+    '''
+    return {s: _toArr(tzPairs) for s, tzPairs in tzData.items()}
+
+def _toTZDict(tzData):
+    '''
+    Convert dict with (N,2) arrays to dict with tzPair lists
+    '''
+    return {s: _toTZList(tzArr) for s, tzArr in tzData.items()}
+
+def _jit(func):
+    '''
+    Compile 'func' with numba, if available. Numba is optional:
+    without it, 'func' runs as plain python.
+    '''
+    if (njit is None): return func
+    return njit(cache=True)(func)
+
+def _linearCoefs(ts, zs):
+    '''
+    Precompute slopes and intercepts of the intervals of series (ts, zs),
+    so interpolation in interval i is lms[i]*t+lbs[i].
+    Returns (lms, lbs), one shorter than the series.
+    '''
+    lms=np.diff(zs)/np.diff(ts)
+    lbs=zs[:-1]-lms*ts[:-1]
+
+    return lms, lbs
+
+@_jit
+def _integrateSegment(lts, lms, lbs, mts, mzs, afterDate):
+    '''
+    Calculate the average shift (and the weight) of series lts (with
+    slopes and intercepts lms, lbs, see _linearCoefs) relative to median
+    segment (mts, mzs), by integrating the difference over the time
+    intervals of the median.
+    All time values of the series must occur in the median.
+    Returns (dz, dt)
+    '''
+    # Start off the counters & admin
+    idx=0
+    dz=0.0
+    dt=0.0
+    t1=mts[0]
+    z1=mzs[0]
+
+    # Loop as long as points left, calculate dz along the way
+    for jdx in range(1, len(mts)):
+        t0=t1
+        z0=z1
+        t1=mts[jdx]
+        z1=mzs[jdx]
+
+        # Move index to the first t greater than the current time
+        # Since all times in the series must occur in the median, we
+        # are sure to step one step at a time
+        while(idx<len(lts)) and (lts[idx]<t1):
+            idx+=1
+        ifrom=idx-1
+
+        # Integrate by interval. Note we know that all time values occur
+        # in the median series.
+        if(0 < idx < len(lts)):
+            ito=idx
+            lt0=lts[ifrom]
+            lt1=lts[ito]
+
+            if(t0>=lt0 and t1<=lt1):
+                z0_int=lms[ifrom]*t0+lbs[ifrom]
+                z1_int=lms[ifrom]*t1+lbs[ifrom]
+                w=1.0
+                if (t0<afterDate):
+                    w=0.01
+                dz+=((z0-z0_int)+(z1-z1_int))/2*(t1-t0)*w
+                dt+=(t1-t0)*w
+
+    if (dt>0):
+        dz/=dt
+
+    return dz, dt
+
+@_jit
+def _groupOnTime(ts, timeTol):
+    '''
+    Label sorted times 'ts' with a group index. A group starts at the first
+    time not within 'timeTol' of the start of the previous group.
+    '''
+    igroup=np.zeros(len(ts), dtype=np.int64)
+    jgroup=0
+    tstart=ts[0] if len(ts)>0 else 0.0
+    for idx in range(len(ts)):
+        if (abs(ts[idx]-tstart)>=timeTol):
+            jgroup+=1
+            tstart=ts[idx]
+        igroup[idx]=jgroup
+
+    return igroup
+
 ###############################################
 #
 # TODO: REWRITE FOR DATAFRAMES
@@ -59,11 +210,54 @@ def AnalyzeTZSeries(tzData, afterDate=0, timeTol=30):
     tzData2 = {MEDIAN: mtzlist, ...} (one extra for each segment)
     tzData3 = {SEGMENT: segments, DZ: dz}
     '''
+    tzData2, tzData3 = _analyzeTZArrays(_toArrDict(tzData), afterDate=afterDate,
+                                        timeTol=timeTol)
+
+    return _toTZDict(tzData2), tzData3
+
+def _locateOnGrid(tlists, timeTol):
+    '''
+    Build the time grid (all time points) for the list of sorted time
+    arrays 'tlists', and locate each grid interval in each time array.
+    Returns (ts, locs), where locs has an (icols, ito) pair for each
+    time array: the grid intervals it covers, and for each of those the
+    index of the end of the covering data interval.
+    '''
+    # Get a list of all time points
+    ts=np.unique(np.concatenate(tlists))
+    t0s=ts[:-1]
+    t1s=ts[1:]
+    tmid=(t0s+t1s)/2
+
+    locs=list()
+    for lts in tlists:
+        # Index of the first t not less than the end of the interval
+        ito=np.searchsorted(lts, t1s, side='left')
+        # IF WE ARE AT THE END, HAVE SOME TOLERANCE!!
+        # HACK
+        ito[(ito==len(lts)) & (lts[-1]>t1s-timeTol)]-=1
+
+        icols=np.flatnonzero((ito>0) & (ito<len(lts)))
+        ito=ito[icols]
+        inside=(lts[ito-1]-timeTol<tmid[icols]) & (tmid[icols]<=lts[ito]+timeTol)
+        locs.append((icols[inside], ito[inside]))
+
+    return ts, locs
+
+def _analyzeTZArrays(tzData, afterDate=0, timeTol=30, gridCache=None):
+    '''
+    Implementation of AnalyzeTZSeries, for a dict with (N,2) arrays
+    (see _toArr). The medians are returned as (N,2) arrays as well.
+
+    If a dict 'gridCache' is supplied, the time grid and the location
+    of the series on it are stored there, keyed on the series' times,
+    and reused by later calls with the same times.
+    '''
     # Anything to do?
     if (len(tzData) == 0):
-        tzData2 = {MEDIAN: []}
+        tzData2 = {MEDIAN: _toArr([])}
         idx=0
-        tzData2[MEDIAN_SEGMENT+str(idx)] = []
+        tzData2[MEDIAN_SEGMENT+str(idx)] = _toArr([])
         tzData3 = {SEGMENT: [], DZ: []}
         return tzData2, tzData3
 
@@ -71,244 +265,121 @@ def AnalyzeTZSeries(tzData, afterDate=0, timeTol=30):
     if (afterDate is None): afterDate=1e-10
 
     # Performance timing
-    start=time.time() # TIME
+    if (_PROFILE): start=time.time()
 
-    # Get a list of all time points
-    ts=set()
-    for srvy in tzData:
-        for tz in tzData[srvy]:
-            ts.add(tz[0])
-    ts=list(ts)
-    ts.sort()
-
-    # Performance timing
-    global times
-    times[1]+=time.time()-start
-    start=time.time() # TIME
-
-    # Deal with time-duplicates
+    # Deal with time-duplicates (series are sorted, so these are
+    # consecutive): replace them by their median.
     tzlistdict=dict()
     for srvy, tzPairs in tzData.items():
-        subdict=list()
-        tzlistdict[srvy]=subdict
-        foundDupl=False
-        tprev=None
-        zprev=list()
-        for tz in tzPairs:
-            if(tz[0]==tprev):
-                foundDupl=True
-                zprev.append(tz[1])
-                #print("****duplicate time!!", tz[0])
-            else:
-                if (foundDupl):
-                    # Different time. Deal with preceding duplicate if any
-                    z=statistics.median(zprev)
-                    subdict[-1]=(tprev,z)
-                subdict.append(tz)
-                tprev=tz[0]
-                zprev=[tz[1]]
-                foundDupl=False
-
-        # If the duplicates were the last few points, deal with that
-        if (foundDupl):
-            z=statistics.median(zprev)
-            subdict[-1]=(tprev,z)
+        isnew=np.concatenate(([True], np.diff(tzPairs[:,0])!=0))
+        if (np.all(isnew)):
+            # Nothing to do (the usual case)
+            tzlistdict[srvy]=tzPairs
+        else:
+            zMed=pd.Series(tzPairs[:,1]).groupby(np.cumsum(isnew)).median()
+            tzlistdict[srvy]=np.column_stack((tzPairs[isnew,0],
+                                              zMed.to_numpy(dtype=np.float64)))
 
     # Performance timing
-    times[2]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times, 2, start)
 
-    # Start off the counters & admin
-    idx=dict()
-    for srvy in tzlistdict:
-        idx[srvy]=0
-    jdx=0
-    t1=ts[jdx]
-    z1=0
-    otzlistlist=list()
-    otzlistlist.append(list())
-    otzlistlist[-1].append((t1,z1))
-
-    # Loop as long as points left, calculate & integrate median
-    # subsidence speed along the way
-    # Split data into segments if they is no contiguous coverage
-    while (True):
-        jdx+=1
-        if (jdx>=len(ts)): break
-        t0=t1
-        z0=z1
-        t1=ts[jdx]
-        #print("Processing interval", t0, "to", t1)
-
-        # Move all indexes that point to a t less than the current time
-        for srvy, subdict in tzlistdict.items():
-            while(idx[srvy]<len(subdict)) and (subdict[idx[srvy]][0]<t1):
-                idx[srvy]+=1
-            # IF WE ARE AT THE END, HAVE SOME TOLERANCE!!
-            # HACK
-            if(idx[srvy]==len(subdict)) and (subdict[idx[srvy]-1][0]>t1-timeTol):
-                idx[srvy]-=1
-
-        # Calculate derivatives
-        dzdt=[]
-        for srvy, subdict in tzlistdict.items():
-            if(idx[srvy]>0 and idx[srvy]<len(subdict)):
-                ifrom=idx[srvy]-1
-                ito=idx[srvy]
-                lt0=subdict[ifrom][0]
-                lt1=subdict[ito][0]
-                tmid=(t0+t1)/2
-
-                if(lt0-timeTol<tmid<=lt1+timeTol):
-                    lz0=subdict[ifrom][1]
-                    lz1=subdict[ito][1]
-                    dzdt.append((lz1-lz0)/(lt1-lt0))
-
-        # integrate median subsidence speed, if any found
-        # otherwise start afresh. The relative position of the
-        # new segment remains to be determined
-        if(len(dzdt)>0):
-            dzdtm=statistics.median(dzdt)
-            z1=z0+dzdtm*(t1-t0)
-        else:
-            #print("*** no derivative between",t0,t1)
-            dzdtm=None
-            z1=0
-            otzlistlist.append(list())
+    # Get the time grid, and the location of the series on it
+    tlists=[subdict[:,0] for subdict in tzlistdict.values()]
+    if (gridCache is None):
+        ts, locs = _locateOnGrid(tlists, timeTol)
+    else:
+        key=(timeTol,)+tuple(lts.tobytes() for lts in tlists)
+        try:
+            ts, locs = gridCache[key]
+        except KeyError:
+            ts, locs = gridCache[key] = _locateOnGrid(tlists, timeTol)
+    t0s=ts[:-1]
+    t1s=ts[1:]
 
-        otzlistlist[-1].append((t1,z1))
+    # Performance timing
+    if (_PROFILE): start=_lap(times, 1, start)
+
+    # Slopes and intercepts of each series, used for the derivatives
+    # and for the interpolation later on
+    coefs=[_linearCoefs(subdict[:,0], subdict[:,1])
+           for subdict in tzlistdict.values()]
+
+    # Calculate derivatives for each interval between consecutive time
+    # points, for each series that covers it (NaN if it does not)
+    dzdt=np.full((len(tzlistdict), len(t1s)), np.nan)
+    for isrvy, (lms, _) in enumerate(coefs):
+        (icols, ito) = locs[isrvy]
+        dzdt[isrvy, icols]=lms[ito-1]
+
+    # Median subsidence speed per interval, if any found
+    hasdzdt=~np.all(np.isnan(dzdt), axis=0)
+    dzdtm=np.zeros(len(t1s))
+    dzdtm[hasdzdt]=np.nanmedian(dzdt[:,hasdzdt], axis=0)
+
+    # Integrate median subsidence speed. Where no speed is available,
+    # start afresh. The relative position of the new segment remains
+    # to be determined. So split data into segments if there is no
+    # contiguous coverage
+    dzm=dzdtm*(t1s-t0s)
+    istarts=np.concatenate(([0], np.flatnonzero(~hasdzdt)+1))
+    iends=np.concatenate((istarts[1:], [len(ts)]))
+    otzlistlist=[np.column_stack((ts[i0:i9], np.cumsum(np.concatenate(([0.], dzm[i0:i9-1])))))
+                 for i0, i9 in zip(istarts, iends)]
 
     # Performance timing
-    times[3]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times, 3, start)
 
     # Every input series must be contained in a single segment.
-    # Todo: this is slow
-    segments=dict()
-    for srvy, subdict in tzlistdict.items():
-        t0=subdict[0][0]
-        for j, sublist in enumerate(otzlistlist):
-            tstart=sublist[0][0]
-            tend=sublist[-1][0]
-            if (tstart <= t0 <= tend):
-                segments[srvy]=j
-                break
+    # Find it from the position of the series' first time on the grid.
+    its=np.searchsorted(ts, [subdict[0,0] for subdict in tzlistdict.values()])
+    isegs=np.searchsorted(istarts, its, side='right')-1
 
     # Performance timing
-    times[4]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times, 4, start)
 
     # Finally, align the segments vertically.
     # Every input series must be contained in a single segment.
-    dz=dict()
-    dt=dict()
-    for srvy, subdict in tzlistdict.items():
-        iseg=segments[srvy]
+    dz=np.zeros(len(tzlistdict))
+    dt=np.zeros(len(tzlistdict))
+    for isrvy, subdict in enumerate(tzlistdict.values()):
+        sublist=otzlistlist[isegs[isrvy]]
 
         # Series of length 1 need to be dealt with differently
         if(len(subdict)==1):
-            lt0=subdict[0][0]
-            for tz in otzlistlist[iseg]:
-                if (tz[0]==lt0):
-                    dz[srvy]=tz[1]-subdict[0][1]
-                    dt[srvy]=0
+            jdx=np.searchsorted(sublist[:,0], subdict[0,0])
+            dz[isrvy]=sublist[jdx,1]-subdict[0,1]
         else:
-            # Start off the counters & admin
-            idx=0
-            dz[srvy]=0
-            dt[srvy]=0
-            jdx=0
-            t1=otzlistlist[iseg][jdx][0]
-            z1=otzlistlist[iseg][jdx][1]
-
-            # Loop as long as points left, calculate dz along the way
-            while (True):
-                jdx+=1
-                if (jdx>=len(otzlistlist[iseg])): break
-                t0=t1
-                z0=z1
-                t1=otzlistlist[iseg][jdx][0]
-                z1=otzlistlist[iseg][jdx][1]
-
-                # Move index to the first t greater than the current time
-                # Since all times in the series must occur in the median, we
-                # are sure to step one step at a time
-                while(idx<len(subdict)) and (subdict[idx][0]<t1):
-                    idx+=1
-                ifrom=idx-1
-
-                # Integrate by interval. Note we know that all time values occur
-                # in the median series.
-                if(0 < idx < len(subdict)):
-                    ito=idx
-                    lt0=subdict[ifrom][0]
-                    lt1=subdict[ito][0]
-
-                    if(t0>=lt0 and t1<=lt1):
-                        lz0=subdict[ifrom][1]
-                        lz1=subdict[ito][1]
-
-                        z0_int=(t0-lt0)/(lt1-lt0)*(lz1-lz0)+lz0
-                        z1_int=(t1-lt0)/(lt1-lt0)*(lz1-lz0)+lz0
-                        w=1
-                        if (t0<afterDate):
-                            w=0.01
-                        dz[srvy]+=((z0-z0_int)+(z1-z1_int))/2*(t1-t0)*w
-                        dt[srvy]+=(t1-t0)*w
-
-            if (dt[srvy]>0):
-                dz[srvy]/=dt[srvy]
+            dz[isrvy], dt[isrvy] = _integrateSegment(subdict[:,0], *coefs[isrvy],
+                                    sublist[:,0], sublist[:,1], float(afterDate))
 
     # Performance timing
-    times[5]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times, 5, start)
 
     # Calculate average shift per segment
-    cnt=dict()
-    dz_avg=dict()
-    dz_wgt=dict()
-    for iseg in range(len(otzlistlist)):
-        dz_avg[iseg]=0
-        dz_wgt[iseg]=0
-        cnt[iseg]=0
-    for srvy, ldz in dz.items():
-        iseg=segments[srvy]
-        w=max(0.001,dt[srvy]) # TODO (default tiny weight)
-        dz_avg[iseg]+=ldz*w
-        dz_wgt[iseg]+=w
-        cnt[iseg]+=1
+    nseg=len(otzlistlist)
+    cnt=np.bincount(isegs, minlength=nseg)
+    if (np.any(cnt==0)):
+        print("****Empty segment? Should this happen?")
+        print("****Check data is sorted...")
+        assert(0)
+    w=np.maximum(0.001,dt) # TODO (default tiny weight)
+    dz_avg=(np.bincount(isegs, weights=dz*w, minlength=nseg)/
+            np.bincount(isegs, weights=w, minlength=nseg))
 
     # Shift segments
     for iseg, sublist in enumerate(otzlistlist):
-        if (cnt[iseg]>0):
-            dz_avg[iseg]/=dz_wgt[iseg]
-
-            # Shift tuple in sublist
-            ll = len(sublist)
-            for indx in range(ll):
-                tz=sublist[indx]
-                sublist[indx]=(tz[0],tz[1]-dz_avg[iseg])
-        else:
-            print("****Empty segment? Should this happen?")
-            print("****Check data is sorted...")
-            assert(0)
+        sublist[:,1]-=dz_avg[iseg]
 
     # Map shifts to survey (each survey is in one segment)
-    for srvy in dz:
-        iseg=segments[srvy]
-        dz[srvy]-=dz_avg[iseg]
+    dz-=dz_avg[isegs]
 
-    times[6]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times, 6, start)
 
     # Prepare merged list as well as the per-segment list
-    mtzlist=[]
-    for seg_median in otzlistlist:
-        mtzlist += seg_median
+    mtzlist=np.concatenate(otzlistlist)
 
     # Performance timing
-    times[7]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times, 7, start)
 
     # Collate output. Label segments uniquely (TODO: can't we use indexes?)
     tzData2 = {MEDIAN: mtzlist}
@@ -316,8 +387,8 @@ def AnalyzeTZSeries(tzData, afterDate=0, timeTol=30):
     for seg_median in otzlistlist:
         tzData2[MEDIAN_SEGMENT+str(idx)] = seg_median
         idx += 1
-    segments = {s: MEDIAN_SEGMENT+str(seg) for s, seg in segments.items()}
-    tzData3 = {SEGMENT: segments, DZ: dz}
+    segments = {s: MEDIAN_SEGMENT+str(seg) for s, seg in zip(tzlistdict, isegs.tolist())}
+    tzData3 = {SEGMENT: segments, DZ: dict(zip(tzlistdict, dz.tolist()))}
 
     return tzData2, tzData3
 
@@ -331,30 +402,16 @@ def MergeTZSeries(tzData, timeTol=30):  # TODO: Odd results for large timeTol
 
     Returns merged tzData (dict with a single element, key MERGE)
     '''
-    # Merge all
-    tzPairs1 = list()
-    for s in tzData:
-        tzPairs1.extend(tzData[s])
-    tzPairs1.sort()
-
-    # Check duplicates
-    tzPairs2 = list()
-    tDup = []
-    zDup = []
-    for (t,z) in tzPairs1:
-        if (len(tDup)>0 and abs(t-tDup[0])<timeTol):
-            tDup.append(t)
-            zDup.append(z)
-        else:
-            if (len(zDup)>0):
-                tzPairs2[-1]=(statistics.median(tDup),
-                              statistics.median(zDup))
-            tzPairs2.append((t,z))
-            tDup = [t]
-            zDup = [z]
-    if (len(zDup)>1):
-        tzPairs2[-1]=(statistics.median(tDup),
-                      statistics.median(zDup))
+    # Merge all, sort on t (and z)
+    tzArr = np.concatenate([_toArr(tzPairs) for tzPairs in tzData.values()]
+                           or [_toArr([])])
+    tzArr = tzArr[np.lexsort((tzArr[:,1], tzArr[:,0]))]
+
+    # Check duplicates: points within timeTol of the first point of
+    # a group are replaced by the group median
+    igroup = _groupOnTime(tzArr[:,0], float(timeTol))
+    tzMed = pd.DataFrame(tzArr).groupby(igroup, sort=True).median()
+    tzPairs2 = _toTZList(tzMed.to_numpy(dtype=np.float64))
 
     tzData3 = dict()
     tzData3[MERGE] = tzPairs2
@@ -370,16 +427,17 @@ def AlignMedian(tzData, refDate, **kwargs):
 
     Returns shifted tzData
     '''
-    tzMeds, _ = AnalyzeTZSeries(tzData, **kwargs)
+    tzData = _toArrDict(tzData)
+
+    tzMeds, _ = _analyzeTZArrays(tzData, **kwargs)
 
-    dz = IF.Interpolate(tzMeds[MEDIAN], refDate, extrapol=False)
+    dz = _zAt(tzMeds[MEDIAN], refDate)
 
     tzData[MEDIAN] = tzMeds[MEDIAN]
 
-    for s in tzData:
-        tzData[s] = [(t, z-dz) for (t,z) in tzData[s]]
+    ApplyZShift(tzData, -dz)
 
-    return tzData
+    return _toTZDict(tzData)
 
 # Performance timing
 times3=dict()
@@ -399,53 +457,49 @@ def AlignAllMedian(tzData, refDate, **kwargs):
 
     Returns shifted tzData
     '''
+    return _toTZDict(_alignAllMedianArrays(_toArrDict(tzData), refDate, **kwargs))
+
+def _alignAllMedianArrays(tzData, refDate, gridCache=None, **kwargs):
+    '''
+    Implementation of AlignAllMedian, for a dict with (N,2) arrays
+    (see _toArr). Returns a dict with (N,2) arrays.
+    See _analyzeTZArrays for 'gridCache'.
+    '''
     # Performance timing
-    start=time.time() # TIME
+    if (_PROFILE): start=time.time()
 
-    # So we can modify
-    tzData = copy.deepcopy(tzData)
+    # So we can modify (a plain copy per array suffices)
+    tzData = {srvy: tzArr.copy() for srvy, tzArr in tzData.items()}
 
     # Performance timing
-    times3[0]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times3, 0, start)
 
     # Anything to do?
     if (len(tzData)==0):
         return tzData
 
     # Calculate the median, and shifts between the curves
-    tzMed, dzSrvy = AnalyzeTZSeries(tzData, **kwargs)
-
-    # Performance timing
-    times3[1]+=time.time()-start
-    start=time.time() # TIME
-
-    # Align curves to the median
-    for srvy in tzData:
-        dz = float(dzSrvy[DZ][srvy])
-        tzPairs = tzData[srvy]
-        tzData[srvy] = [(tz[0], tz[1]+dz) for tz in tzPairs]
+    tzMed, dzSrvy = _analyzeTZArrays(tzData, gridCache=gridCache, **kwargs)
 
     # Performance timing
-    times3[2]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times3, 1, start)
 
     # Calculate the shift of the median to be zero at the refDate
-    dz = IF.Interpolate(tzMed[MEDIAN], refDate, extrapol=False)
+    dz = _zAt(tzMed[MEDIAN], refDate)
 
     # Performance timing
-    times3[3]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times3, 3, start)
 
-    # Include the median, and apply the overall shift
-    tzData[MEDIAN] = tzMed[MEDIAN]
+    # Align curves to the median, and apply the overall shift, in one go
     for srvy in tzData:
-        tzPairs = tzData[srvy]
-        tzData[srvy] = [(tz[0], tz[1]-dz) for tz in tzPairs]
+        tzData[srvy][:,1] += float(dzSrvy[DZ][srvy]) - dz
+
+    # Include the median (overall shift only)
+    tzData[MEDIAN] = tzMed[MEDIAN]
+    tzData[MEDIAN][:,1] -= dz
 
     # Performance timing
-    times3[4]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times3, 4, start)
 
     return tzData
 
@@ -458,6 +512,19 @@ for i in range(20):
 def GETTIME2():
     return times2
 
+def _alignAllMedianChunk(tzMultiData, refDate, **kwargs):
+    '''
+    Do AlignAllMedian for each peilmerk in 'tzMultiData' (keyed on
+    peilmerk name, each element a dict with tzPair lists).
+    Returns dict keyed on peilmerk name, with dicts with (N,2) arrays.
+    '''
+    # Peilmerken measured at the same times share the time grid
+    gridCache = dict()
+
+    return {lspm: _alignAllMedianArrays(_toArrDict(tzSpm), refDate,
+                                        gridCache=gridCache, **kwargs)
+            for lspm, tzSpm in tzMultiData.items()}
+
 def AlignAllMedian2Level(tzMultiData, refDate, **kwargs):
     '''
     Output is a dict, keyed on peilmerk name. Each element is again
@@ -470,7 +537,7 @@ def AlignAllMedian2Level(tzMultiData, refDate, **kwargs):
     Times are in days since T0 (1-1-1970).
     '''
     # Performance timing
-    start=time.time() # TIME
+    if (_PROFILE): start=time.time()
 
     # Anything to do?
     if (len(tzMultiData)==0):
@@ -480,113 +547,71 @@ def AlignAllMedian2Level(tzMultiData, refDate, **kwargs):
         return tzOut
 
     # List of keys at 2nd level
-    pms = tzMultiData.keys()
-
-    # Init admin
-    tzOut = dict()
-    tzMeds = dict()
+    pms = list(tzMultiData.keys())
 
     # Performance timing
-    times2[0]+=time.time()-start
-    start=time.time() # TIME
-
-    # Loop over 2nd level
-    for lspm in pms:
-        # Performance timing
-        times2[1]+=time.time()-start
-        start=time.time() # TIME
-
-        # Get subset
-        tzSpm = tzMultiData[lspm]
-
-        # Performance timing
-        times2[2]+=time.time()-start
-        start=time.time() # TIME
-
-        # Do 1st level
-        tzCurMed = AlignAllMedian(tzSpm, refDate, **kwargs)
-
-        # Performance timing
-        times2[3]+=time.time()-start
-        start=time.time() # TIME
+    if (_PROFILE): start=_lap(times2, 0, start)
 
-        # Extract and collect the medians (with proper key)
-        tzMeds[lspm] = tzCurMed[MEDIAN]
-
-        # Performance timing
-        times2[5]+=time.time()-start
-        start=time.time() # TIME
-
-        # Collate the level1-aligned data
-        tzOut[lspm] = tzCurMed
+    # Do 1st level. The peilmerken are independent, so if there are many
+    # split them in chunks to be done in parallel.
+    if (Parallel is None) or (len(pms)<PARALLEL_MIN_PMS):
+        tzOut = _alignAllMedianChunk(tzMultiData, refDate, **kwargs)
+    else:
+        nChunks = min(effective_n_jobs(-1), len(pms))
+        lChunk = -(-len(pms)//nChunks)
+        tzChunks = [{lspm: tzMultiData[lspm] for lspm in pms[i:i+lChunk]}
+                    for i in range(0, len(pms), lChunk)]
+        tzOut = dict()
+        for tzChunkOut in Parallel(n_jobs=nChunks)(
+                delayed(_alignAllMedianChunk)(tzChunk, refDate, **kwargs)
+                for tzChunk in tzChunks):
+            tzOut.update(tzChunkOut)
 
-        # Performance timing
-        times2[6]+=time.time()-start
-        start=time.time() # TIME
+    # Extract and collect the medians (with proper key)
+    tzMeds = {lspm: tzCurMed[MEDIAN] for lspm, tzCurMed in tzOut.items()}
 
     # Performance timing
-    times2[7]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times2, 7, start)
 
     # Calculate the median of medians, and the shifts needed to align at level 2
-    tzAllMed, dzSpm = AnalyzeTZSeries(tzMeds, **kwargs)
+    tzAllMed, dzSpm = _analyzeTZArrays(tzMeds, **kwargs)
 
     # Performance timing
-    times2[8]+=time.time()-start
-    start=time.time() # TIME
-
-    # Align curves to the level-2 median
-    for lspm in dzSpm[DZ]:
-        dz = float(dzSpm[DZ][lspm])
-        for lsrvy in tzOut[lspm]:
-            tzPairs = tzOut[lspm][lsrvy]
-            ll = len(tzPairs)
-            for indx in range(ll):
-                tz = tzPairs[indx]
-                tzPairs[indx] = (tz[0], tz[1]+dz)
-
-    # Performance timing
-    times2[9]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times2, 8, start)
 
     # Calculate the shift of the median of medians to be zero at the refDate
     tzMed2 = tzAllMed[MEDIAN]
-    dz = IF.Interpolate(tzMed2, refDate, extrapol=False)
+    dz = _zAt(tzMed2, refDate)
 
     # Performance timing
-    times2[10]+=time.time()-start
-    start=time.time() # TIME
+    if (_PROFILE): start=_lap(times2, 10, start)
 
-    # Include the level 2 median in the output
+    # Align curves to the level-2 median, and apply the overall level 2
+    # shift, in one go
+    for lspm, tzData in tzOut.items():
+        ApplyZShift(tzData, float(dzSpm[DZ].get(lspm, 0)) - dz)
+
+    # Include the level 2 median in the output (overall shift only)
+    tzMed2[:,1] -= dz
     tzOut[MEDIAN] = dict()
     tzOut[MEDIAN][MEDIAN] = tzMed2
 
     # Performance timing
-    times2[11]+=time.time()-start
-    start=time.time() # TIME
-
-    # Apply the overall level 2 shift
-    for lspm, tzData in tzOut.items():
-        ApplyZShift(tzData, -dz)
+    if (_PROFILE): start=_lap(times2, 12, start)
 
-    # Performance timing
-    times2[12]+=time.time()-start
-    start=time.time() # TIME
-
-    return tzOut
+    return {lspm: _toTZDict(tzData) for lspm, tzData in tzOut.items()}
 
 def ApplyZShift(tzData, dz):
     '''
-    Apply z shift to tzData = dict, each element being a list of (t,z) tuples
+    Apply z shift (in place) to tzData = dict, each element being an (N,2)
+    array (see _toArr) or a list of (t,z) tuples
     '''
-    for lsrvy in tzData:
-        tzPairs = tzData[lsrvy]
-        ll = len(tzPairs)
-        # Need to modify tuples in list
-        for indx in range(ll):
-            tz = tzPairs[indx]
-            tzPairs[indx] = (tz[0], tz[1]+dz)
-        #tzData[lsrvy] = tzPairs # redundant
+    for tzArr in tzData.values():
+        if isinstance(tzArr, np.ndarray):
+            tzArr[:,1] += dz
+        else:
+            # Need to replace the tuples in the list
+            tzArr[:] = _toTZList(_toArr(tzArr) + (0, dz))
 
 def AlignAllSegmentMedian(tzData, refDate, timeTol=30, **kwargs):
     '''
@@ -595,7 +620,8 @@ def AlignAllSegmentMedian(tzData, refDate, timeTol=30, **kwargs):
     connected to refDate is dropped.
     '''
     # Calculate basics
-    tzMed, dzData = AnalyzeTZSeries(tzData, timeTol=timeTol, **kwargs)
+    tzData = _toArrDict(tzData)
+    tzMed, dzData = _analyzeTZArrays(tzData, timeTol=timeTol, **kwargs)
 
     # Figure out in which segment the time is located
     g0 = None
@@ -606,7 +632,7 @@ def AlignAllSegmentMedian(tzData, refDate, timeTol=30, **kwargs):
             d1 = tzPairs[0][0]
             d2 = tzPairs[-1][0]
             if (d1<=refDate+timeTol) and (d2>=refDate-timeTol):
-                dz = IF.Interpolate(tzPairs, refDate, extrapol=False)
+                dz = _zAt(tzPairs, refDate)
                 tz0 = tzPairs
                 g0 = g
                 break
@@ -625,7 +651,7 @@ def AlignAllSegmentMedian(tzData, refDate, timeTol=30, **kwargs):
     tzData[MEDIAN_SEGMENT]=tz0
     ApplyZShift(tzData, dz)
 
-    return tzData
+    return _toTZDict(tzData)
 
 def CalcAlignment(tzData1, tzData2, focusAfterDated=None, timeTol=30): # days
     '''
@@ -635,118 +661,46 @@ def CalcAlignment(tzData1, tzData2, focusAfterDated=None, timeTol=30): # days
     dz=0.0
     if(len(tzData1)==0 or len(tzData2)==0): return dz
 
-    # Prepare admin
-    dtz = []
-    i1 = 0
-    i2 = 0
-    (tL1,zL1) = (None,None)
-    (t1,z1) = tzData1[i1]
-    (tL2,zL2) = (None,None)
-    (t2,z2) = tzData2[i1]
-
-    # Loop over all points in the two series.
-    # Build a list of (t,dz) pairs, where each dz is a
-    # z-value from one series minus an interpolation
-    # from the other (or vice versa)
-    while (True):
-        if(t1<t2):
-            # t1 is the first point in line
-            # can we interpolate?
-            if(tL2 is not None):
-                zInt1=z1
-                zInt2=(t1-tL2)/(t2-tL2)*(z2-zL2)+zL2
-                dtz.append((t1,zInt2-zInt1))
-
-            # Move to the next point
-            i1+=1
-            (tL1,zL1)=(t1,z1)
-            if (i1>=len(tzData1)):
-                break
-            (t1,z1)=tzData1[i1]
-        elif(t2<t1):
-            # t2 is the first point in line
-            # can we interpolate?
-            if(tL1 is not None):
-                zInt1=(t2-tL1)/(t1-tL1)*(z1-zL1)+zL1
-                zInt2=z2
-                dtz.append((t2,zInt2-zInt1))
-            # Move to the next point
-            i2+=1
-            (tL2,zL2)=(t2,z2)
-            if (i2>=len(tzData2)):
-                break
-            (t2,z2)=tzData2[i1]
-        else: #(t2==t1):
-            # t1=t2 is the first point in line
-            # can we interpolate?
-            zInt1=z1
-            zInt2=z2
-            dtz.append((t1,zInt2-zInt1))
-            tA=t1
-
-            # Move to the next point depending on the next value
-            if (i1>=len(tzData1)-1):
-                if (i2>=len(tzData2)-1):
-                    # both at the end: we're done
-                    break
-                #1 at the end, move #2
-                moveIt=2
-            elif (i2>=len(tzData2)-1):
-                #2 at the end, move #1
-                moveIt=1
-            else:
-                #both have space. Move the one with the smallest next value
-                if (tzData1[i1+1][0]<tzData2[i2+1][0]):
-                    moveIt=1
-                else:
-                    moveIt=2
-
-            if (moveIt==1):
-                (tL1,zL1)=(t1,z1)
-                i1+=1
-                (t1,z1)=tzData1[i1]
-            else:
-                (tL2,zL2)=(t2,z2)
-                i2+=1
-                (t2,z2)=tzData2[i2]
+    tzArr1 = _toArr(tzData1)
+    tzArr2 = _toArr(tzData2)
+    (t1,z1) = (tzArr1[:,0],tzArr1[:,1])
+    (t2,z2) = (tzArr2[:,0],tzArr2[:,1])
+
+    # Build (t,dz) pairs on all time points of the two series where they
+    # overlap, where each dz is a z-value from one series minus an
+    # interpolation from the other (or vice versa)
+    # Cut both series to the overlap before merging the time points.
+    # This is cheap if a short series lies within a long one.
+    (tlo,thi) = (max(t1[0],t2[0]), min(t1[-1],t2[-1]))
+    ts = np.union1d(t1[np.searchsorted(t1, tlo):np.searchsorted(t1, thi, side='right')],
+                    t2[np.searchsorted(t2, tlo):np.searchsorted(t2, thi, side='right')])
+    dzs = np.interp(ts, t2, z2) - np.interp(ts, t1, z1)
 
     # Was a focusdate supplied? Set a dummy date to facilitate comparison
     if (focusAfterDated is None): focusAfterDated=0
 
     # Final integration. Handle cases with zero/one points
-    if (len(dtz)==0):
+    if (len(ts)==0):
         #print("Zero points, no overlap")
-        if (i1>=len(tzData1) and i2==0):
-            if (tL1+timeTol>t2):
-                #print("but it's close!")
-                dtz.append(((tL1+t2)/2,z2-zL1))
-        elif (i2>=len(tzData2) and i1==0):
-            if (tL2+timeTol>t1):
-                #print("but it's close!")
-                dtz.append(((t1+tL2)/2,zL2-z1))
-
-    if (len(dtz)==0):
+        if (t1[-1]<t2[0]) and (t1[-1]+timeTol>t2[0]):
+            #print("but it's close!")
+            ts = np.array([(t1[-1]+t2[0])/2])
+            dzs = np.array([z2[0]-z1[-1]])
+        elif (t2[-1]<t1[0]) and (t2[-1]+timeTol>t1[0]):
+            #print("but it's close!")
+            ts = np.array([(t1[0]+t2[-1])/2])
+            dzs = np.array([z2[-1]-z1[0]])
+
+    if (len(ts)==0):
         raise NoOverlapException("Really zero points, no overlap")
-    elif (len(dtz)==1) or (dtz[-1][0]==dtz[0][0]):
+    elif (len(ts)==1):
         #print("One point")
-        dz=(dtz[-1][1]+dtz[0][1])/2
+        dz=float(dzs[0])
     else:
-        # Calculate the actual alignment
+        # Calculate the actual alignment (trapezoidal integration)
         # Focus on time after 'focusAfterDated' if possible
-        (t1,dz1)=dtz[0]
-        dt=0.0
-        for indx in range(1,len(dtz)):
-            (t2,dz2)=dtz[indx]
-
-            w=1.0
-            if (t2<focusAfterDated):
-                w=0.001 # TODO: UGLY
-
-            dz += (t2-t1)*w*(dz1+dz2)/2
-            dt += (t2-t1)*w
-
-            (t1,dz1)=(t2,dz2)
-
-        dz /= dt
+        dts = np.diff(ts)
+        w = np.where(ts[1:]<focusAfterDated, 0.001, 1.0) # TODO: UGLY
+        dz = float(np.sum(dts*w*(dzs[:-1]+dzs[1:])/2) / np.sum(dts*w))
 
     return -dz
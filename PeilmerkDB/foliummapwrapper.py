@@ -4,14 +4,20 @@ Module provides wrapper object to generate folium maps
 matplotlib maps)
 Can only be run in batch.
 '''
-import geopandas as gpd
+import io
+import json
+import numpy as np
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 import folium
 import branca.colormap as cm
+from branca.element import MacroElement
+from jinja2 import Template
 
 #import shapefile
-from shapely.geometry import Polygon, MultiPoint
-#from shapely.geometry import MultiPolygon, Point
 from skimage import measure
 
 from . import genplotwrapper as GW
@@ -21,6 +27,134 @@ from . import messagelogger as ML
 CRS_RD = GMW.CRS_RD
 CRS_WGS84 = GMW.CRS_WGS84
 
+# Number of entries in the color lookup tables
+LUT_SIZE = 1024
+
+################################################################################
+
+def _scriptJSON(obj):
+    '''
+    Compact JSON text of obj, safe to embed in a <script> block
+    (same escaping as jinja's tojson filter)
+    '''
+    txt = json.dumps(obj, separators=(',', ':'))
+    return (txt.replace('<', '\\u003c').replace('>', '\\u003e')
+               .replace('&', '\\u0026').replace("'", '\\u0027'))
+
+def _mapColors(cmap, values):
+    '''
+    Vectorized equivalent of cmap(v) for an array of values:
+    interpolate each RGBA channel, then format as "#RRGGBBAA".
+    '''
+    rgba = np.asarray(cmap.colors, dtype=float)
+    chans = np.column_stack([np.interp(values, cmap.index, rgba[:,j])
+                             for j in range(4)])
+    chans = (chans*255.9999).astype(int)
+    return ['#%02x%02x%02x%02x' % tuple(c) for c in chans.tolist()]
+
+def _bilinear(G, pts):
+    '''
+    Bilinear interpolation of grid G at fractional (row, column)
+    positions pts (array of shape (N,2), as from measure.find_contours)
+    '''
+    ix = np.minimum(pts[:,0].astype(int), G.shape[0]-2)
+    iy = np.minimum(pts[:,1].astype(int), G.shape[1]-2)
+    fx = pts[:,0]-ix
+    fy = pts[:,1]-iy
+    return (G[ix,iy]*(1-fx)*(1-fy) + G[ix+1,iy]*fx*(1-fy) +
+            G[ix,iy+1]*(1-fx)*fy   + G[ix+1,iy+1]*fx*fy)
+
+def _bilinearXYLoop(X2, Y2, pts):
+    '''
+    As _bilinear, for grids X2 and Y2 at once, as an explicit loop
+    (for compilation with numba)
+    '''
+    n = pts.shape[0]
+    xds = np.empty(n)
+    yds = np.empty(n)
+    for k in range(n):
+        ix = min(int(pts[k,0]), X2.shape[0]-2)
+        iy = min(int(pts[k,1]), X2.shape[1]-2)
+        fx = pts[k,0]-ix
+        fy = pts[k,1]-iy
+        w00 = (1-fx)*(1-fy)
+        w10 = fx*(1-fy)
+        w01 = (1-fx)*fy
+        w11 = fx*fy
+        xds[k] = (X2[ix,iy]*w00 + X2[ix+1,iy]*w10 +
+                  X2[ix,iy+1]*w01 + X2[ix+1,iy+1]*w11)
+        yds[k] = (Y2[ix,iy]*w00 + Y2[ix+1,iy]*w10 +
+                  Y2[ix,iy+1]*w01 + Y2[ix+1,iy+1]*w11)
+    return xds, yds
+
+def _bilinearXY(X2, Y2, pts):
+    '''
+    Bilinear interpolation of grids X2 and Y2 at positions pts.
+    Numba is optional: without it, the vectorized numpy version is used.
+    '''
+    return _bilinear(X2, pts), _bilinear(Y2, pts)
+
+if (njit is not None):
+    _bilinearXY = njit(cache=True)(_bilinearXYLoop)
+
+################################################################################
+
+class _CircleMarkers(MacroElement):
+    '''
+    All circle markers of a layer, as a single GeoJSON layer.
+    Avoids building (and rendering) a CircleMarker and Popup object per point;
+    the browser gets one data blob and one Leaflet layer.
+    Repeated addPoints calls on a layer append to the same element.
+    '''
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.geoJSON({{ this.getPayload() }}, {
+                pointToLayer: function (feature, latlng) {
+                    var props = feature.properties;
+                    return L.circleMarker(latlng, Object.assign({},
+                        {{ this.options|tojson }},
+                        {"color": props.color, "fillColor": props.color,
+                         "radius": props.radius}));
+                },
+                onEachFeature: function (feature, layer) {
+                    if (feature.properties.popup !== null) {
+                        layer.bindPopup(feature.properties.popup);
+                    }
+                }
+            }).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self):
+        super().__init__()
+        self._name = 'CircleMarkers'
+        self._features = io.StringIO()
+        self.options = folium.vector_layers.path_options(line=False, fill=True)
+
+    def addPoints(self, points, radius):
+        '''
+        Add points (list of (lat, lon, color, popup)).
+        The features are pre-rendered in python, so the template
+        only has to paste them in.
+        '''
+        if (len(points)==0):
+            return
+        txt = _scriptJSON([
+            {"type": "Feature",
+             "geometry": {"type": "Point", "coordinates": [lon, lat]},
+             "properties": {"color": color, "radius": radius, "popup": ftxt}}
+            for (lat, lon, color, ftxt) in points])
+        if (self._features.tell()>0):
+            self._features.write(',')
+        self._features.write(txt[1:-1])
+
+    def getPayload(self):
+        '''
+        The GeoJSON FeatureCollection (as text) with all points added
+        '''
+        return ('{"type":"FeatureCollection","features":[' +
+                self._features.getvalue() + ']}')
+
 ################################################################################
 
 class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
@@ -30,6 +164,18 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
     matplotlib maps)
     Can only be run in batch.
     '''
+    # Background tile layers (tiles, attribution, name)
+    _TILE_SPECS = (
+        ('http://services.arcgisonline.com/arcgis/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}',
+            'Esri', 'World Street Map'),
+        ('openstreetmap', None, 'Open Street Map'),
+        ('stamentoner', None, 'Black & White'),
+        ('cartodbpositron', None, 'Light'),
+        ('cartodbdark_matter', None, 'Dark'),
+        ('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+            'Esri', 'Satellite'),
+        )
+
     def __init__(self, name, mgr, warp=False):
         GMW.GenMapWrapper.__init__(self, warp = warp)
         GW.GenPlotWrapper.__init__(self, name, mgr, "folium")
@@ -37,51 +183,44 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
         assert(not warp)
         
         self._kol = folium.Map(tiles=None, control_scale=True)
-        folium.TileLayer(         
-            tiles = 'http://services.arcgisonline.com/arcgis/rest/services/World_Street_Map/MapServer/tile/{z}/{y}/{x}',
-            attr = 'Esri',
-            name = 'World Street Map',
-            overlay = False,
-            control = True).add_to(self._kol)            
-        folium.TileLayer('openstreetmap', name = 'Open Street Map').add_to(self._kol)
-        folium.TileLayer('stamentoner', name = 'Black & White').add_to(self._kol)
-        folium.TileLayer('cartodbpositron', name = 'Light').add_to(self._kol)
-        folium.TileLayer('cartodbdark_matter', name = 'Dark').add_to(self._kol)
-        folium.TileLayer(
-            tiles = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-            attr = 'Esri',
-            name = 'Satellite',
-            overlay = False,
-            control = True).add_to(self._kol)
+        for (tiles, attr, tname) in self._TILE_SPECS:
+            folium.TileLayer(tiles, attr=attr, name=tname).add_to(self._kol)
         #folium.TileLayer('Stamen Terrain').add_to(self._kol)
         #folium.TileLayer('HERE.normalday').add_to(self._kol)
-        self._ll_min=(1e38,1e38)
-        self._ll_max=(-1e38,-1e38)
+        self._lat_min=self._lon_min=1e38
+        self._lat_max=self._lon_max=-1e38
         self._layers={}
         self._cmaps={}
+        self._luts={}
+        self._markers={}
         
         self._inProgress = True
 
     def _updateBounds(self,lat, lon):
-        self._ll_min=(min(self._ll_min[0],lat),
-                            min(self._ll_min[1],lon))
-        self._ll_max=(max(self._ll_max[0],lat),
-                            max(self._ll_max[1],lon))
+        lat=float(lat)
+        lon=float(lon)
+        if (lat<self._lat_min): self._lat_min=lat
+        if (lat>self._lat_max): self._lat_max=lat
+        if (lon<self._lon_min): self._lon_min=lon
+        if (lon>self._lon_max): self._lon_max=lon
                             
     def getMapBounds(self, expand=1):
         '''
         Get map bounds (in RD)
         '''
         assert(0)# Convert to RD
-        return (*self._ll_min, *self._ll_max)
+        return (self._lat_min, self._lon_min, self._lat_max, self._lon_max)
         
     def _getLayer(self, lname):
         '''
         Access plot layer 'lname'
         '''
-        if (not lname in self._layers):
-            self._layers[lname]=folium.FeatureGroup(name=lname).add_to(self._kol)
-        return self._layers[lname]
+        try:
+            return self._layers[lname]
+        except KeyError:
+            lyr=folium.FeatureGroup(name=lname).add_to(self._kol)
+            self._layers[lname]=lyr
+            return lyr
     
     def getFileExtension(self):
         '''
@@ -101,7 +240,8 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
         '''
         if (fileName is None):
             fileName="FoliumMap.html"
-        self._kol.fit_bounds([self._ll_min,self._ll_max])
+        self._kol.fit_bounds([(self._lat_min,self._lon_min),
+                              (self._lat_max,self._lon_max)])
         folium.LayerControl().add_to(self._kol)
         self._kol.save(outfile=fileName)
         
@@ -144,6 +284,23 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
             index=index, vmin=cmin,vmax=cmax,
             caption=caption)
         self._cmaps[cname].add_to(self._kol)
+
+        # Dense lookup table of colors, so values can be mapped in one go
+        self._luts[cname] = (cmin, cmax, np.array(_mapColors(self._cmaps[cname],
+                                        np.linspace(cmin, cmax, LUT_SIZE))))
+
+    def _lookupColors(self, cname, values, nanColor):
+        '''
+        Colors for an array of values, from the lookup table of colormap 'cname'.
+        Values that are NaN (or infinite) get 'nanColor'.
+        '''
+        (cmin, cmax, lut) = self._luts[cname]
+        scale = (len(lut)-1)/(cmax-cmin) if (cmax>cmin) else 0.
+        valid = np.isfinite(values)
+        idx = np.clip(np.rint((np.where(valid, values, cmin)-cmin)*scale), 0, len(lut)-1)
+        colors = lut[idx.astype(np.intp)].astype(object)
+        colors[~valid] = nanColor
+        return colors.tolist()
          
     def addPoints(self, df, zKey=None,
                     labelKey=None,
@@ -153,11 +310,12 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
         '''
         Add points to map. Can be called multiple times.
         Data provided as geodataframe, zkey column contains height diffs,
-        labelKey optional popups.
+        labelKey optional popups (shown as HTML).
         The points are called 'layer' (for legend).
         If 'useForZoom' is False, the map is not zoomed out to accomodate the data.
         'cname' specifies the name of the color map to use (if non-default), 'color'
-        the color to use no z-value coloring is to be used.
+        the color to use no z-value coloring is to be used (also for points
+        with a NaN z-value).
         '''
         if (layer is None):
             layer="Points"
@@ -165,7 +323,7 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
 
         zValues = None
         if not (zKey is None):
-            zValues = list(df[zKey].values)
+            zValues = df[zKey].to_numpy(dtype=float)
             if (len(self._cmaps)==0):
                 raise KeyError("No Color map defined")
             if (cname is None):
@@ -175,37 +333,45 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
  
         labels = None
         if not (labelKey is None):
-            labels = list(df[labelKey].values)
+            labels = df[labelKey].astype(str).to_numpy()
   
         if (color is None):
             color='blue'
         
-        # Make sure we're a geodataframe
-        df = self.convertToGeoDataFrame(df)
+        # Get x,y in source CRS, then convert (if needed) to target CRS
+        # in one go (avoids a geopandas.to_crs round-trip)
+        xs, ys, crs = self.getCoordinateArrays(df)
+        if (crs is not None and crs==CRS_WGS84):
+            lons, lats = xs, ys
+        else:
+            lons, lats = GMW.GetTransformer(crs, CRS_WGS84).transform(xs, ys)
+
+        npts=len(xs)
+        if (npts==0):
+            return
+        if (useForZoom):
+            self._updateBounds(lats.min(), lons.min())
+            self._updateBounds(lats.max(), lons.max())
+
+        # Colors and popups for all points at once
+        if not (zValues is None):
+            fcolors=self._lookupColors(cname, zValues, color)
+        else:
+            fcolors=[color]*npts
+        if not (labels is None):
+            # As HTML, like folium's Popup (parse_html=False)
+            ftxts=labels.tolist()
+        else:
+            ftxts=[None]*npts
+        points=list(zip(lats.tolist(), lons.tolist(), fcolors, ftxts))
         
-        # Convert (if needed) to target CRS 
-        df2 = df.to_crs(epsg=CRS_WGS84)
-                
-        # Get output as Point list, then convert to x,y
-        # TODO: Plot straight from geodataframe!?
-        lons = [p.x for p in df2.geometry.to_list()]
-        lats = [p.y for p in df2.geometry.to_list()]
-
-        npts=len(df)
-        for i in range(npts):
-            (lon, lat) = (lons[i], lats[i])
-            if (useForZoom):
-                self._updateBounds(lat, lon)
-            if not (zValues is None):
-                fcolor=self._cmaps[cname](zValues[i])
-            else:
-                fcolor=color
-            if not (labels is None):
-                ftxt=str(labels[i])
-            else:
-                ftxt=None
-            folium.CircleMarker((lat,lon), radius=1*size, 
-                        color=fcolor, popup=ftxt, fill=True).add_to(flyr)
+        # One marker element per layer
+        try:
+            mrks=self._markers[layer]
+        except KeyError:
+            mrks=_CircleMarkers().add_to(flyr)
+            self._markers[layer]=mrks
+        mrks.addPoints(points, radius=1*size)
         
     def addPolygon(self, polygon_points, useForZoom=True):
         '''
@@ -229,15 +395,15 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
         # Loop over the parts (this is ugly)
         # AND WRONG
         for i in range(len(pts)-1):
-            p = Polygon(shp.points[pts[i]:pts[i+1]])
-            # Convert to lat/lon
-            locs=[]
-            xs, ys = p.exterior.xy
-            for x,y in zip(xs,ys):
-                lat,lon = self._convertFromRD((x,y))
-                if (useForZoom):
-                    self._updateBounds(lat, lon)
-                locs.append((lat,lon))
+            # Convert to lat/lon (closing the ring, as Polygon did)
+            xy = np.asarray(shp.points[pts[i]:pts[i+1]], dtype=float)
+            if not (xy[0]==xy[-1]).all():
+                xy = np.vstack((xy, xy[:1]))
+            lls = self._convertFromRD(xy)
+            if (useForZoom):
+                self._updateBounds(*lls[:,::-1].min(axis=0))
+                self._updateBounds(*lls[:,::-1].max(axis=0))
+            locs = lls[:,::-1].tolist()
             folium.PolyLine(locs,
                     color='black',
                     weight=1,
@@ -250,37 +416,33 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
         assert(0) # untested
         flyr=self._getLayer("Contours")
         
+        # Loop-invariant lookups
+        cmap=None if (cname is None) else self._cmaps[cname]
+        convertFromRD=self._convertFromRD
+        updateBounds=self._updateBounds
+        
+        # Levels outside the data range have no contours, so don't
+        # scan the grid for them. Convert the grid only once.
+        S2=np.ascontiguousarray(S2, dtype=float)
+        (smin, smax)=(np.nanmin(S2), np.nanmax(S2))
+        levels=[cc for cc in range(10,100,5) if (smin<=cc<=smax)]
+        
         # Loop over contour levels
-        for cc in range(10,100,5):
+        for cc in levels:
+            # Color depends on level only
+            ccolor='red' if (cmap is None) else cmap(cc)
+            
             # Determine contout
             SC=measure.find_contours(S2, cc)
             # A contour can consist of multiple parts!
-            ncont=len(SC)
-            for icont in range(ncont):
-                lcont=len(SC[icont])
-                xyds=[]
-                for jcont in range(lcont):
-                    (x,y)=SC[icont][jcont]
-                    ix=int(x)
-                    iy=int(y)
-                    fx=x-ix
-                    fy=y-iy
-                    xd=(X2[ix,iy]*(1-fx)*(1-fy) + X2[ix+1,iy]*fx*(1-fy) + 
-                        X2[ix,iy+1]*(1-fx)*fy   + X2[ix+1,iy+1]*fx*fy)
-                    yd=(Y2[ix,iy]*(1-fx)*(1-fy) + Y2[ix+1,iy]*fx*(1-fy) + 
-                        Y2[ix,iy+1]*(1-fx)*fy   + Y2[ix+1,iy+1]*fx*fy)
-                    xyds.append((xd,yd))
-
-                ll_contour=[]
-                for x,y in xyds:
-                    lat,lon = self._convertFromRD((x,y))
-                    self._updateBounds(lat, lon)                    
-                    ll_contour.append((lat,lon))
+            for pts in SC:
+                xds, yds=_bilinearXY(X2, Y2, pts)
+
+                lls=convertFromRD(np.column_stack((xds, yds)))
+                updateBounds(*lls[:,::-1].min(axis=0))
+                updateBounds(*lls[:,::-1].max(axis=0))
+                ll_contour=lls[:,::-1].tolist()
                 
-                if (cname is None):
-                    ccolor='red'
-                else:
-                    ccolor=self._cmaps[cname](cc)
                 folium.Polygon(ll_contour,
                                 fill_color=ccolor,#'blue',
                                 fill_opacity=0.1,
@@ -290,14 +452,9 @@ class FoliumWrapper(GMW.GenMapWrapper, GW.GenPlotWrapper):
 
     def _convertFromRD(self, xy):  
         '''
-        Convert xy's from RD to lon,lat
+        Convert xy's (array of shape (N,2)) from RD to lon,lat
+        (returned as array of the same shape)
         '''
-        # Convert from espg used to RD, whose epsg is 28992 (RD)
-        gs = gpd.GeoSeries(MultiPoint(xy), crs=CRS_RD)
-
-        # Convert to lat/lon (WGS84)
-        gs2 = gs.to_crs(epsg=CRS_WGS84)
-
-        # Get output as Point list, convert to x,y list
-        xy_o = [(p.x, p.y) for p in list(gs2.to_list()[0].geoms)]
-        return xy_o
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        lons, lats = GMW.GetTransformer(CRS_RD, CRS_WGS84).transform(xy[:,0], xy[:,1])
+        return np.column_stack((lons, lats))
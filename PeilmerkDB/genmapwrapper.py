@@ -2,10 +2,12 @@
 Generic (abstract) base classes to facilitate managing various
 kinds of maps (folium, contextily/matplotlib)
 '''        
+import functools
 from shapely.geometry import Point, Polygon
 #from shapely.geometry import MultiPoint
 import geopandas as gpd
 import pandas as pd
+import pyproj
 
 from . import coordsys as CS
 
@@ -13,6 +15,15 @@ CRS_RD=CS.CRS_RD
 CRS_WGS84=CS.CRS_WGS84 # (4326 = lon,lat)
 CRS_TILE=CS.CRS_TILE # Used in web tile services
 
+@functools.lru_cache(maxsize=None)
+def GetTransformer(crsFrom, crsTo):
+    '''
+    Get a (cached) transformer between two coordinate systems.
+    Setting up a pyproj transformation is expensive, so
+    we do it only once per pair. Axis order is always x,y (lon,lat).
+    '''
+    return pyproj.Transformer.from_crs(crsFrom, crsTo, always_xy=True)
+
 class GenMapWrapper:
     '''
     Generic (abstract) base class to facilitate managing various
@@ -93,6 +104,24 @@ class GenMapWrapper:
             gdf.set_crs(epsg=CRS_RD, inplace=True)
         return gdf
         
+    def getCoordinateArrays(self, df):
+        '''
+        Utility to get x and y arrays (and the CRS they are in)
+        from various inputs, without building shapely Points
+        where that is not needed.
+        Inputs as for convertToGeoDataFrame.
+        '''
+        if (isinstance(df, gpd.GeoDataFrame)):
+            gdf = df
+        elif (isinstance(df, pd.DataFrame)):
+            # Plain DataFrame is in RD
+            xs = df[self.xkey].to_numpy(dtype=float)
+            ys = df[self.ykey].to_numpy(dtype=float)
+            return xs, ys, CRS_RD
+        else:
+            gdf = self.convertToGeoDataFrame(df)
+        return gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy(), gdf.crs
+
     def getMapBounds(self, expand=1):
         '''
         To be overloaded to return the bounds of the currently shown map
@@ -4,6 +4,21 @@ kinds of plots
 '''
 from . import peilmerkdatabase as PM # For keys
 
+# The color scale we use (RGB is easier), and its inverse
+_COLOR_SCALE = (
+    (0.00, (  0,  0,255)), # blue
+    (0.08, (128,128,255)), # light blue
+    (0.16, (128,255,128)), # light green
+    (0.25, (  0,255,  0)), # green
+    (0.37, (128,255,  0)), # lime
+    (0.50, (255,255,  0)), # yellow
+    (0.63, (255,128,  0)), # orange
+    (0.75, (255,  0,  0)), # red
+    (0.87, (180, 14, 14)), # burgundy
+    (1.00, (110, 28, 28)), # brown
+    )
+_COLOR_SCALE_INVERTED = tuple((1.0-p, col) for p, col in _COLOR_SCALE)
+
 class GenPlotManager:
     '''
     Generic (abstract) base class for objects that manage a number of
@@ -121,27 +136,7 @@ class GenPlotWrapper:
             colors[0.87] = (180, 14, 14) # burgundy
             colors[1.00] = (110, 28, 28) # brown
         '''
-        # RGB is easier
-        colors = dict()
-        colors[0.00] = (  0,  0,255) # blue
-        colors[0.08] = (128,128,255) # light blue
-        colors[0.16] = (128,255,128) # light green
-        colors[0.25] = (  0,255,  0) # green
-        colors[0.37] = (128,255,  0) # lime
-        colors[0.50] = (255,255,  0) # yellow
-        colors[0.63] = (255,128,  0) # orange
-        colors[0.75] = (255,  0,  0) # red
-        colors[0.87] = (180, 14, 14) # burgundy
-        colors[1.00] = (110, 28, 28) # brown
-        
-        # Invert
-        if (inverted):
-            c2 = dict()
-            for p, col in colors.items():
-                c2[1.0-p]=col
-            colors = c2   
-            
-        return colors
+        return dict(_COLOR_SCALE_INVERTED if (inverted) else _COLOR_SCALE)
 
     def close(self): 
         '''
@@ -2,13 +2,13 @@
 Module provides class for map plotting (in matplotlib/contextily).
 There is also a folium version.
 '''
+import functools
+import math
 import numpy as np
-from shapely.geometry import Point, MultiPoint
 # from shapely.geometry import Polygon
 import geopandas as gpd
 import pandas as pd
-
-import traceback
+import pyproj
 
 from matplotlib_scalebar.scalebar import ScaleBar
 from matplotlib import colors as col
@@ -16,12 +16,24 @@ import contextily as ctx
 
 from . import matplotwrapper as MPW
 from . import genmapwrapper as GMW
-from . import mptimer as MPT
 
 CRS_RD = GMW.CRS_RD
 CRS_TILE = GMW.CRS_TILE
 
-DISTANCE_KEY = "Distance"
+# In vector output (pdf, svg) of maps with at least this many points,
+# everything below RASTER_ZORDER (basemap and point layers) is drawn as
+# a single image; lines, text and the scalebar stay vector
+RASTERIZE_MIN_POINTS = 20000
+RASTER_ZORDER = 1.5
+
+# Delay (ms) before the basemap of an interactive plot is (re)drawn
+BASEMAP_DELAY = 250
+
+# Number of basemap images kept in memory (for revisited views)
+BASEMAP_CACHE_SIZE = 32
+
+# Basemap used by default
+DEFAULT_MAP_SOURCE = "WorldStreetMap"
 
 _map_sources={
         "CartoDB": ctx.providers.CartoDB.Voyager,
@@ -32,6 +44,25 @@ _map_sources={
         "OpenTopo": ctx.providers.OpenTopoMap,
         "":None
         }
+
+@functools.lru_cache(maxsize=BASEMAP_CACHE_SIZE)
+def _basemapImage(srcKey, crs, bounds, zoom):
+    '''
+    Fetch the basemap tiles for 'bounds' (xmin, ymin, xmax, ymax, in 'crs'),
+    stitched and warped to 'crs'. Returns image and its extent.
+    Cached, so zooming back to an earlier view does not fetch it again.
+    '''
+    mapSrc = _map_sources[srcKey]
+    (xmin, ymin, xmax, ymax) = bounds
+    
+    # Tiles are in the web tile CRS
+    if not (crs is None):
+        (xmin, ymin, xmax, ymax) = GMW.GetTransformer(crs, CRS_TILE).transform_bounds(
+                    xmin, ymin, xmax, ymax)
+    img, extent = ctx.bounds2img(xmin, ymin, xmax, ymax, zoom=zoom, source=mapSrc, ll=False)
+    if not (crs is None):
+        img, extent = ctx.warp_tiles(img, extent, t_crs=crs)
+    return img, extent
     
 class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
     '''
@@ -58,15 +89,27 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         
         self._warp = warp
         
+        # The CRS we plot in (built once, used for every conversion)
+        self._mapCRS = pyproj.CRS.from_epsg(self.getCRS())
+        
         self._timer = None
-        self._annotation = None
         self._plotted = None
+        self._nPoints = 0
 
         self._crs = None
 
         self._timerB = None
         
-    def _getMapSource(self, key="WorldStreetMap"):
+        # Basemap source and its maximum zoom level (no limit if not given)
+        self._mapKey = DEFAULT_MAP_SOURCE
+        self._mapSrc = self._getMapSource(self._mapKey)
+        self._maxZoom = None
+        if not (self._mapSrc is None):
+            self._maxZoom = self._mapSrc.get("max_zoom", None)
+        self._basemap = None
+        self._attribution = None
+        
+    def _getMapSource(self, key=DEFAULT_MAP_SOURCE):
         try:
             source = _map_sources[key]
         except KeyError:
@@ -74,19 +117,23 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         return source
 
     def plotBasemapInteractive(self):
-        print("GPWrapper.plotBasemapInteractive")
-        #for line in traceback.format_stack():
-        #    print(line.strip())
-        
-        #if (self._timerB is None):
-        #    self._timerB = MPT.MPTimer(self._inDialog.getWidget(), 1000, 
-        #            lambda: GPWrapper._after_redraw_request(self))
-        #else:
-            #self._timerB.start(1000)
+        '''
+        Add basemap (contextily) to an interactive plot, after a short delay.
+        Repeated requests within the delay (e.g. while zooming or panning)
+        restart the timer, so tiles are only fetched once things settle.
+        '''
+        if (self._timerB is None):
+            self._timerB = self._fig.canvas.new_timer(interval=BASEMAP_DELAY)
+            self._timerB.single_shot = True
+            self._timerB.add_callback(self._after_redraw_request)
+        self._timerB.start()
 
-    #def _after_redraw_request(self):
-        #print("GPWrapper._after_redraw_request")
+    def _after_redraw_request(self):
+        '''
+        Basemap timer callback (internal)
+        '''
         self.plotBasemap()
+        self._fig.canvas.draw_idle()
         
     def plotBasemap(self, xtraZoom=0):     
         '''
@@ -95,7 +142,7 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         '''   
         
         # Source of map
-        mapSrc=self._getMapSource()
+        mapSrc=self._mapSrc
         if (mapSrc is None):
             return
 
@@ -104,15 +151,25 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         ymin, ymax = self._ax.get_ylim()
         dx = abs(xmax-xmin)
         dy = abs(ymax-ymin)
-        zoom = 26 - int(np.log((dx+dy)/2)/np.log(2)) + xtraZoom
+        zoom = 26 - int(math.log2(max(1.0, (dx+dy)/2))) + xtraZoom
+        
+        # Not beyond what the source provides
+        if not (self._maxZoom is None):
+            zoom = min(zoom, self._maxZoom)
         
-        # Test if zoom: 28 is valid or not?
-        retval = mapSrc.get("max_zoom", zoom)
-        #print("    plotting map, zoom=", zoom, "max: ", retval)
-        zoom = min(zoom, retval)
+        # Plot the map (keeping the current limits)
+        bounds = (round(xmin), round(ymin), round(xmax), round(ymax))
+        img, extent = _basemapImage(self._mapKey, self._crs, bounds, zoom)
+        if not (self._basemap is None):
+            self._basemap.remove()
+        self._basemap = self._ax.imshow(img, extent=extent, interpolation="bilinear",
+                        aspect=self._ax.get_aspect())
+        self._ax.axis((xmin, xmax, ymin, ymax))
         
-        # Plot the map
-        ctx.add_basemap(self._ax, zoom=zoom, source=mapSrc, crs=self._crs)
+        # Attribution only once
+        attribution = mapSrc.get("attribution")
+        if (attribution and self._attribution is None):
+            self._attribution = ctx.add_attribution(self._ax, attribution)
     
     def getCRS(self):
         '''
@@ -120,6 +177,15 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         '''
         return CRS_RD if (self._warp) else CRS_TILE
     
+    def _toMapCRS(self, gdf):
+        '''
+        Convert GeoDataFrame/GeoSeries to the CRS the map is plotted in.
+        Returned as is if it is in that CRS already.
+        '''
+        if (gdf.crs is not None and gdf.crs==self._mapCRS):
+            return gdf
+        return gdf.to_crs(self._mapCRS)
+    
     def addPoints(self, df, zKey=None,
                     labelKey=None,
                     cname=None, color=None, edgeColor=None, # TODO
@@ -138,12 +204,11 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         df = self.convertToGeoDataFrame(df)
         
         # Convert (if needed) to target CRS
-        df2 = df.to_crs(epsg=CRS_RD if (self._warp) else CRS_TILE)
+        df2 = self._toMapCRS(df)
                 
-        # Get output as Point list, then convert to x,y
-        # TODO: Plot straight from geodataframe!?
-        xo = [p.x for p in df2.geometry.to_list()]
-        yo = [p.y for p in df2.geometry.to_list()]
+        # Get output as x,y arrays
+        xo = df2.geometry.x.to_numpy()
+        yo = df2.geometry.y.to_numpy()
 
         # Z data (assumes df is (geo)dataframe)
         if (zKey is None): zKey = ""
@@ -179,41 +244,52 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         kwargs=dict()
         if not (zorder is None):
             kwargs["zorder"] = zorder
+        if (zorder is None or zorder<RASTER_ZORDER):
+            self._nPoints += len(xo)
             
         if not (labelKey is None):
             if (self._plotted is None):
                 self._plotted = list()
-            self._plotted.append((df, labelKey, zKey, layer))
+            # Coordinates (in the CRS of the data) and labels for the
+            # hover search. We don't hold on to (or modify) the frame itself.
+            # Single precision is plenty for hovering.
+            xs = df.geometry.x.to_numpy(dtype=np.float32)
+            ys = df.geometry.y.to_numpy(dtype=np.float32)
+            labels = df[labelKey].to_numpy()
+            self._plotted.append((xs, ys, labels, zKey, layer))
             
         # ... then add the data
         if (zKey==""):
-            im = self._ax.scatter(xo, yo, 
-                        #scalex=useForZoom, scaley=useForZoom,
-                        c=color, s=size*5, label=layer,
-                        linewidth=1.3 if color == "none" else .3,
+            # Single color: plain markers are much cheaper than a scatter
+            # collection. Same zorder as scatter, to keep the layer order.
+            kwargs.setdefault("zorder", 1)
+            self._ax.plot(xo, yo, linestyle="none",
+                        markerfacecolor=color, markersize=np.sqrt(size*5), label=layer,
+                        markeredgewidth=1.3 if color == "none" else .3,
                         marker="o" if marker is None else marker,
-                        edgecolors="black" if edgeColor is None else edgeColor, **kwargs)
+                        markeredgecolor="black" if edgeColor is None else edgeColor, **kwargs)
         else:
+            cmap = self._cmaps[cname]
             im = self._ax.scatter(xo, yo, 
                         #scalex=useForZoom, scaley=useForZoom,
                         s=size*5, c=zvalues, 
-                        cmap=self._cmaps[cname]["cmap"],
-                        vmin=self._cmaps[cname]["min"], 
-                        vmax=self._cmaps[cname]["max"], 
+                        cmap=cmap["cmap"],
+                        vmin=cmap["min"], 
+                        vmax=cmap["max"], 
                         linewidth=.3, label=layer,
                         marker="o" if marker is None else marker,
                         edgecolors="black" if edgeColor is None else edgeColor, **kwargs)
                                     
             # Show the legend for this colorbar
-            if (not ("shown" in self._cmaps[cname])) or (not self._cmaps[cname]["shown"]):
-                self.plotColorBar(im, self._cmaps[cname]["caption"])
-                self._cmaps[cname]["shown"] = True
+            if not cmap.get("shown", False):
+                self.plotColorBar(im, cmap["caption"])
+                cmap["shown"] = True
 
         # Record the line (so we can later scale the legend)
         self.addEntry(layer)
         
         if (useForZoom):
-            self._updateBounds((min(xo), min(yo), max(xo), max(yo)))
+            self._updateBounds(tuple(df2.total_bounds))
     
     def _updateBounds(self, bounds):
         self._xmind=min(self._xmind, bounds[0])
@@ -225,15 +301,10 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         '''
         Get current map bounds (in RD)
         '''
-        # Bounds are in map coordinates
-        xys=[(self._xmind, self._ymind), (self._xmaxd, self._ymaxd)]
-        gs = gpd.GeoSeries(MultiPoint(xys), crs=self._crs)
-
-        # Convert back to RD
-        gs2 = gs.to_crs(epsg=CRS_RD)
-
-        # Get output as Point list, convert to x,y list
-        xy_o = [(p.x, p.y) for p in list(gs2.to_list()[0].geoms)]
+        # Bounds are in map coordinates, convert back to RD
+        (x0, x1), (y0, y1) = GMW.GetTransformer(self._crs, CRS_RD).transform(
+                    (self._xmind, self._xmaxd), (self._ymind, self._ymaxd))
+        xy_o = [(x0, y0), (x1, y1)]
         print(xy_o)
         
         # Return
@@ -282,59 +353,42 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         Pop up info from closest point.
         Overridden from base class because of coord transforms.
         '''
-        self._timer = None
-        
         (xpt,ypt) = (event.xdata, event.ydata)
         event = self.filterEvent(event)
+        key = None
         if not (event.xdata is None):
             # Init admin
             distMin = 1e37
             labMin = ""
+            keyMin = None
             scale = event.plot_scale
             
             # Loop over data stored for the layers
             # In each layer, find the closest point
             # Plot the closest of all
             # Todo: take plotting order inro account
-            for (df, labelKey, zKey, layer) in self._plotted:
-                pxy = Point(event.xdata, event.ydata)
-                df[DISTANCE_KEY]=df.distance(pxy)
-                idx = df[DISTANCE_KEY].idxmin()
-                lDistMin = df[DISTANCE_KEY].loc[idx]
-                lLabMin = df[labelKey].loc[idx]
+            for (il, (xs, ys, labels, zKey, layer)) in enumerate(self._plotted):
+                d2 = (xs-event.xdata)**2 + (ys-event.ydata)**2
+                i = int(np.argmin(d2))
+                lDistMin = np.sqrt(d2[i])
+                lLabMin = labels[i]
                 if (not (layer is None)) and (layer != ""):
                     lLabMin += " ("+layer+")"
                 if (lDistMin<=distMin):
                     distMin = lDistMin
                     labMin = lLabMin
+                    keyMin = (il, i)
             
             # Are we close enough? Distance depends on zoom!
-            if (distMin>10*scale):
-                if not (self._annotation is None):
-                    self._annotation.set_visible(False)
-            else:
+            if (distMin<=10*scale):
+                key = keyMin
                 xpt += 10*scale 
                 ypt += 10*scale 
-                if not (self._annotation is None):
-                    self._annotation.set_text(labMin)
-                    self._annotation.set_x(xpt)
-                    self._annotation.set_y(ypt)
-                else:
-                    self._annotation = self._ax.annotate(labMin, 
-                        xy=(xpt, ypt), xycoords='data',
-                        #xytext=(xpt + xoff, ypt+yoff), textcoords='data',
-                        horizontalalignment="left",
-                        #arrowprops=dict(arrowstyle="simple",
-                        #connectionstyle="arc3,rad=-0.2"),
-                        bbox=dict(boxstyle="round", facecolor="w", 
-                        edgecolor="0.5", alpha=0.9)
-                )
-                self._annotation.set_visible(True)
-        elif not (self._annotation is None):
-            self._annotation.set_visible(False)
-            
-        # Force a redraw
-        self._fig.canvas.draw()
+        
+        if (key is None):
+            self.updateAnnotation(None)
+        else:
+            self.updateAnnotation(key, labMin, xpt, ypt)
         
     def filterEvent(self, event):
         '''
@@ -344,23 +398,18 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         #print("    geopandamapwrapper.filterEvent")
         ia = event.inaxes
         if not (ia is None):
-            # Convert from espg used to RD, whose epsg is 28992 (RD)
-            xy = (event.xdata, event.ydata)
-            gs = gpd.GeoSeries(Point(xy), crs=self._crs)
-            gs2 = gs.to_crs(epsg=28992)
-            xy_o = [(p.x, p.y) for p in list(gs2.to_list())]
+            # Shifted coord to determine scale
+            xd1, yd1 = self.getInvTransData(ia).transform((event.x+1, event.y+1))
+
+            # Convert both from espg used to RD, whose epsg is 28992 (RD)
+            (x0, x1), (y0, y1) = GMW.GetTransformer(self._crs, CRS_RD).transform(
+                    (event.xdata, xd1), (event.ydata, yd1))
             
             # Store the first member back
-            event.xdata = xy_o[0][0]
-            event.ydata = xy_o[0][1]
+            event.xdata = x0
+            event.ydata = y0
 
-            # Shifted coord to determine scale
-            xd1, yd1 = ia.transData.inverted().transform((event.x+1, event.y+1))
-            xy1 = (xd1, yd1)
-            gs = gpd.GeoSeries(Point(xy1), crs=self._crs)
-            gs2 = gs.to_crs(epsg=28992)
-            xy_o1 = [(p.x, p.y) for p in list(gs2.to_list())]
-            scale = np.sqrt((xy_o[0][0]-xy_o1[0][0])**2 + (xy_o[0][1]-xy_o1[0][1])**2)
+            scale = np.sqrt((x0-x1)**2 + (y0-y1)**2)
             event.plot_scale = scale
         else:
             event.xdata = None
@@ -452,10 +501,7 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         # Background and callbacks for the three modes
         # (TODO: more elegantly?)        
         if not (self._inDialog is None):
-            # Wrap up background
-            self.plotBasemapInteractive()
-            
-            # Connect callbacks
+            # Connect callbacks (background follows once embedded)
             self.callbacksConnect()
         elif not (fileName is None):
             # Wrap up background
@@ -467,8 +513,17 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
             # Connect callbacks
             self.callbacksConnect()
 
+        # Many points: points and basemap as one image in vector output
+        if (self._nPoints>=RASTERIZE_MIN_POINTS):
+            self._ax.set_rasterization_zorder(RASTER_ZORDER)
+
         # Rest is done by base class
         MPW.MatPlotWrapper.show(self, fileName=fileName, **kwargs)
+        
+        # Background for embedded plot, now that it has its (tk) canvas,
+        # and thereby a timer that runs in its event loop
+        if not (self._inDialog is None):
+            self.plotBasemapInteractive()
                     
     def addColormap(self,cname,cmin,cmax,inverse=False,caption=None):
         '''
@@ -489,12 +544,11 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         gs = self.convertToGeoSeries(df)            
         
         # Convert (if needed) to target CRS
-        gs2 = gs.to_crs(epsg=CRS_RD if (self._warp) else CRS_TILE)
+        gs2 = self._toMapCRS(gs)
                 
-        # Get output as Point list, then convert to x,y
-        # TODO: Plot straight from geodataframe!?
-        xo = [p.x for p in gs2.to_list()]
-        yo = [p.y for p in gs2.to_list()]
+        # Get output as x,y arrays
+        xo = gs2.x.to_numpy()
+        yo = gs2.y.to_numpy()
  
         # Store the CRS
         self._crs = gs2.crs
@@ -511,18 +565,20 @@ class GPWrapper(GMW.GenMapWrapper, MPW.MatPlotWrapper):
         self._ax.plot(xo, yo, scalex=useForZoom, scaley=useForZoom, c=color)
         
         if (useForZoom):
-            self._updateBounds((min(xo), min(yo), max(xo), max(yo)))
+            self._updateBounds(tuple(gs2.total_bounds))
 
     def addAnnotations(self, coords, annotations):
         # Make sure we're a geodataframe
         df = self.convertToGeoDataFrame(coords)
         
         # Convert (if needed) to target CRS
-        df2 = df.to_crs(epsg=CRS_RD if (self._warp) else CRS_TILE)
+        df2 = self._toMapCRS(df)
 
         # Annotate
-        for indx, p in enumerate(df2.geometry.to_list()):
-            self._ax.annotate(annotations[indx], (p.x, p.y), xytext=(p.x+1500, p.y+1500),
+        xo = df2.geometry.x.to_numpy()
+        yo = df2.geometry.y.to_numpy()
+        for indx, (x, y) in enumerate(zip(xo.tolist(), yo.tolist())):
+            self._ax.annotate(annotations[indx], (x, y), xytext=(x+1500, y+1500),
                                 arrowprops=dict(arrowstyle="->", facecolor='black'))
         
     def addShapes(self, shapes, useForZoom=True):
@@ -1,6 +1,7 @@
 ''''
 Auxiliary interpolation functions
 '''
+import numpy as np
 
 ###############################################################################
 def GetClosest(tzPairs, t): 
@@ -102,3 +103,64 @@ def Interpolate(tzPairs, t, extrapol=True):
         r = y1 + g * (t - x1)
     
     return r
+
+###############################################################################
+def InterpolateMany(ts, zs, tq, extrapol=True):
+    '''
+    Same as Interpolate, but with the series as two arrays 'ts' and 'zs',
+    for an array of times 'tq' at once.
+    Returns an array of heights.
+    
+    raises IndexError if the series is empty
+    '''
+    ts = np.asarray(ts, dtype=float)
+    zs = np.asarray(zs, dtype=float)
+    tq = np.asarray(tq, dtype=float)
+    nx = len(ts)
+    if (nx==0):
+        raise IndexError("Empty series")
+    if (nx<2):
+        return np.full(tq.shape, zs[0])
+    
+    # Decreasing series are searched in reverse
+    if (ts[0] > ts[-1]):
+        ts = ts[::-1]
+        zs = zs[::-1]
+    
+    # Interval (i0,i9) per time, extrapolating from the end intervals
+    i9 = np.clip(np.searchsorted(ts, tq), 1, nx-1)
+    i0 = i9-1
+    g = (zs[i9] - zs[i0]) / (ts[i9] - ts[i0])
+    r = zs[i0] + g * (tq - ts[i0])
+    
+    # Clamp to end values
+    if (not extrapol):
+        r = np.where(tq <= ts[0], zs[0], np.where(tq >= ts[-1], zs[-1], r))
+    
+    return r
+
+###############################################################################
+def GetClosestArr(ts, zs, t):
+    '''
+    Same as GetClosest, but with the series as two arrays 'ts' and 'zs'
+    (same layout as InterpolateMany). Returns the closest (t,z) pair.
+    
+    raises IndexError if the series is empty
+    '''
+    nx = len(ts)
+    if (nx==0):
+        raise IndexError("Empty series")
+    if (nx<2):
+        return (ts[0], zs[0])
+    
+    # Decreasing series are searched in reverse
+    if (ts[0] > ts[-1]):
+        ts = ts[::-1]
+        zs = zs[::-1]
+    
+    # Pick the closest of the two neighbours (this also
+    # takes care of times beyond either end)
+    i9 = min(max(int(np.searchsorted(ts, t)), 1), nx-1)
+    i0 = i9-1
+    i = i0 if abs(t-ts[i0])<abs(t-ts[i9]) else i9
+    return (ts[i], zs[i])
@@ -2,48 +2,71 @@
 Generic (abstract) base classes to facilitate managing various
 kinds of plots using MatPlotLib
 '''
+import functools
+import math
 import numpy as np
+from scipy.spatial import cKDTree
 from matplotlib import pyplot as plt
 from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 from . import genplotwrapper as GW
 from . import embedplotindialog as ED
 from . import messagelogger as ML
-from . import mptimer as MPT
 
-# Default _colors etc.
-_colors=[]
-_colors.append("black")
-_colors.append("blue")
-_colors.append("red")
-_colors.append("green")
-_colors.append("orange")
-_colors.append("yellow")
-_colors.append("grey")
-_colors.append("brown")
-_colors.append("purple")
-_colors.append("hotpink")
-_colors.append("lime")
+# zlib level for png output (fast; files are somewhat larger)
+PNG_COMPRESS_LEVEL = 1
 
-_lstyles=[]
-_lstyles.append("solid")
-_lstyles.append("dotted")
-_lstyles.append("dashdot")
-_lstyles.append("dashed")
-_lstyles.append((0, (3, 5, 1, 5, 1, 5)))
+# Default colors etc.
+_COLORS = (
+    "black",
+    "blue",
+    "red",
+    "green",
+    "orange",
+    "yellow",
+    "grey",
+    "brown",
+    "purple",
+    "hotpink",
+    "lime",
+    )
 
-_mstyles=[]
-_mstyles.append("o")
-_mstyles.append("^")
-_mstyles.append("v")
-_mstyles.append("<")
-_mstyles.append(">")
-_mstyles.append("s")
-_mstyles.append("p")
-_mstyles.append("*")
-_mstyles.append("P")
-_mstyles.append("D")
+_LSTYLES = (
+    "solid",
+    "dotted",
+    "dashdot",
+    "dashed",
+    (0, (3, 5, 1, 5, 1, 5)),
+    )
+
+_MSTYLES = ("o", "^", "v", "<", ">", "s", "p", "*", "P", "D")
+_N_MSTYLES = len(_MSTYLES)
+
+# Number of nearest points considered for ties in hover search
+HOVER_TIES = 8
+
+# Legend layouts computed before, by legend shape
+# (see resizePlotLegendRight/Below)
+_legendRightCache=dict()
+_legendBelowCache=dict()
+
+@functools.lru_cache(maxsize=32)
+def _segmentData(colorItems):
+    '''
+    Convert sorted (p, (r,g,b)) color scale items (0-255) to
+    red/green/blue segment tuples as used by LinearSegmentedColormap
+    '''
+    ps = [p for p, _ in colorItems]
+    rgb = (np.asarray([c for _, c in colorItems], dtype=float)/255).T.tolist()
+    return tuple(tuple((p, v, v) for p, v in zip(ps, chan)) for chan in rgb)
+
+def _iceil(a, b):
+    '''
+    Integer a/b, rounded up
+    '''
+    return -(-a // b)
 
 class MatPlotWrapper(GW.GenPlotWrapper):
     '''
@@ -76,9 +99,21 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         self._entries = list()
         
         self._plotted = None
+        self._hoverXs = None
+        self._hoverYs = None
+        self._hoverLayer = None
+        self._hoverIndx = None
+        self._tree = None
         self._annotation = None
         self._timer = None
+        self._hoverEvent = None
         self._hovercall = None
+        self._drawcall = None
+        self._background = None
+        self._annotationKey = None
+        self._invTransData = None
+        
+        self._pendingLines = dict()
         
     def addEntry(self, name = None):
         '''
@@ -96,6 +131,29 @@ class MatPlotWrapper(GW.GenPlotWrapper):
 
         return lname
         
+    def addEntries(self, names):
+        '''
+        Add layers to admin, as addEntry for each of names, 
+        but in one go (no rescanning of the admin per name).
+        '''
+        known = set(self._entries)
+        nextIdx = dict()
+        lnames = list()
+        for name in names:
+            if (name is None): name=""
+            lname = name
+            idx = nextIdx.get(name, 0) # Lower suffixes all taken already
+            while(lname in known):
+                lname = name +"_"+ str(idx)
+                idx += 1
+            nextIdx[name] = idx
+            known.add(lname)
+            lnames.append(lname)
+            
+        self._entries.extend(lnames)
+        
+        return lnames
+        
     def getAxesObject(self, openIfNeeded=True):
         '''
         Open the plot (if needed), ...
@@ -108,7 +166,7 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         '''
         # Get marker style # idx (to automate differeing marker styles per series)
         '''
-        return _mstyles[idx % len(_mstyles)]
+        return _MSTYLES[idx % _N_MSTYLES]
         
     def getFileExtension(self):
         '''
@@ -130,6 +188,23 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         self._ax = self._fig.subplots() 
         #self._fig.tight_layout()
         
+        # Screen-to-data transform for events, kept until zoom or resize
+        self._invTransData = None
+        self._ax.callbacks.connect('xlim_changed', self._resetInvTransData)
+        self._ax.callbacks.connect('ylim_changed', self._resetInvTransData)
+        self._fig.canvas.mpl_connect('resize_event', self._resetInvTransData)
+        
+        # Hover annotation (hidden until needed)
+        self._annotation = self._ax.annotate("", 
+                        xy=(0, 0), xycoords='data',
+                        #xytext=(xpt + xoff, ypt+yoff), textcoords='data',
+                        horizontalalignment="left",
+                        #arrowprops=dict(arrowstyle="simple",
+                        #connectionstyle="arc3,rad=-0.2"),
+                        bbox=dict(boxstyle="round", facecolor="w", 
+                        edgecolor="0.5", alpha=0.9), animated=True, visible=False
+                )
+        
         self._entries = list()
         
     def resizePlotLegendRight(self, widthPlotArea=8, height=4):
@@ -144,23 +219,27 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         # Number of entries, and length of legend text.
         _, l = self._ax.get_legend_handles_labels()
         numEntries=len(l)
-        maxlen=0
-        for label in l:
-            maxlen=max(len(label),maxlen)  
+        maxlen=max(map(len,l), default=0)
 
-        # Add legend to the right
-        # First compute # of columns and lines
-        nc=int(numEntries/30+0.99)
-        nl=int(numEntries/nc+0.99)
+        key = (numEntries, maxlen, widthPlotArea)
+        try:
+            (nc, fs, width, xfrac) = _legendRightCache[key]
+        except KeyError:
+            # Add legend to the right
+            # First compute # of columns and lines
+            nc=_iceil(numEntries, 30)
+            nl=_iceil(numEntries, nc)
 
-        # Fontsize
-        fs = min(int(170/maxlen), int(210/nl))
-        fs = max(3, fs)
-        
-        width_l=maxlen*fs/100*nc
-        width = widthPlotArea + width_l    
+            # Fontsize
+            fs = min(int(170/maxlen), int(210/nl))
+            fs = max(3, fs)
+            
+            width_l=maxlen*fs/100*nc
+            width = widthPlotArea + width_l    
 
-        xfrac=1-width_l/width
+            xfrac=1-width_l/width
+            _legendRightCache[key] = (nc, fs, width, xfrac)
+        
         self._fig.subplots_adjust(right=xfrac)
         self._fig.set_size_inches(width, height)
 
@@ -177,34 +256,38 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         # Number of entries, and length of legend text.
         _, l = self._ax.get_legend_handles_labels()
         numEntries=len(l)
-        maxlen=0
-        for label in l:
-            maxlen=max(len(label),maxlen)
-        
-        # Font size
-        fs = min(9,max(3,int(200/np.sqrt(numEntries*maxlen))))
-
-        #First calculate # of columns. Take care that there is some overhead apart from the label
-        nc=max(1,int(1000/((maxlen+7)*fs)))
-        nl=int(numEntries/nc+0.99)
+        maxlen=max(map(len,l), default=0)
         
         has_xaxis = self._ax.axes.xaxis.get_visible()
         #has_xannot = len(self._ax.axes.xaxis.get_ticklabels())>0 if has_xaxis else False
         has_xannot = (not self._hideTickLabels) if has_xaxis else False
         has_xlabel = len(self._ax.get_xlabel())>0 if has_xaxis else False
         
-        height_l=(nl+1)*fs/50
-        height = height_l
-        height_t = 0.23
-        height += height_t if has_xlabel else 0 # Axis title
-        height += height_t if has_xannot else 0 # Axis annottion
-        height += height_t # Plot title
-        height_p = heightPlotArea
-        height += height_p # plot itself
+        key = (numEntries, maxlen, has_xlabel, has_xannot, heightPlotArea)
+        try:
+            (fs, nc, height, yfrac1, yfrac2) = _legendBelowCache[key]
+        except KeyError:
+            # Font size
+            fs = min(9,max(3,int(200/math.sqrt(numEntries*maxlen))))
+
+            #First calculate # of columns. Take care that there is some overhead apart from the label
+            nc=max(1,int(1000/((maxlen+7)*fs)))
+            nl=_iceil(numEntries, nc)
+            
+            height_l=(nl+1)*fs/50
+            height = height_l
+            height_t = 0.23
+            height += height_t if has_xlabel else 0 # Axis title
+            height += height_t if has_xannot else 0 # Axis annottion
+            height += height_t # Plot title
+            height_p = heightPlotArea
+            height += height_p # plot itself
+          
+            yfrac1=(height_l+2*height_t)/height # offset to resize plot area relative to total
+            yfrac2=-(height_l+1.95*height_t)/(height_p) # legend relative to figure
+            _legendBelowCache[key] = (fs, nc, height, yfrac1, yfrac2)
+            
         self._fig.set_size_inches(width, height)
-      
-        yfrac1=(height_l+2*height_t)/height # offset to resize plot area relative to total
-        yfrac2=-(height_l+1.95*height_t)/(height_p) # legend relative to figure
         self._fig.subplots_adjust(bottom=yfrac1, top=0.95)
 
         self._ax.legend(loc="lower center", bbox_to_anchor=(0.5, yfrac2), ncol=nc, fontsize=fs,  borderaxespad=0.)
@@ -251,85 +334,164 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         if not (self._annotation is None):
             self._annotation.set_visible(False)
             
-        if not (self._timer is None):
-            self._timer.stop()
-        self._timer = MPT.MPTimer(self._fig.canvas.get_tk_widget(), 1000, 
-                    lambda: MatPlotWrapper._on_hover_time(self, event))
+        # One timer, restarted on every move
+        if (self._timer is None):
+            self._timer = self._fig.canvas.new_timer(interval=1000)
+            self._timer.single_shot = True
+            self._timer.add_callback(self._on_hover_time)
+        self._hoverEvent = event
+        self._timer.start()
 
-    def _on_hover_time(self, event):
+    def _on_hover_time(self):
         '''
         Hover time out callback (internal)
         '''
-        self.hoverTimedOut(event)
+        self.hoverTimedOut(self._hoverEvent)
      
     def hoverTimedOut(self, event):
         '''
         Hover time out callback method that can be overloaded
         '''
-        self._timer = None
         (xpt,ypt) = (event.xdata, event.ydata)
         event = self.filterEvent(event)
+        key = None
         if not (event.xdata is None):
             # Init admin
             distMin = 1e37
             labMin = ""
+            j = None
             xscale = event.plot_xscale
             yscale = event.plot_yscale
             #print(xscale, yscale)
             
-            # Loop over data stored for the layers
-            # In each layer, find the closest point
-            # Plot the closest of all
+            # Find the closest point over all layers at once,
+            # then look up which layer (and which point in it) that is
             # TODO: take plotting order inro account
-            for (df, xs, ys, indxs, labelKey, layer) in self._plotted:
-                l = len(xs)
-                for i in range(l):
-                    dist = np.sqrt(((xpt - xs[i])/xscale)**2 + ((ypt-ys[i])/yscale)**2)
-                    if (dist < distMin):
-                        distMin = dist
-                        if (not (labelKey is None)) and (labelKey != ""):
-                            labMin = str(df.loc[indxs[i]][labelKey])
-                        else:
-                            labMin = str(indxs[i])
-                        if (not (layer is None)) and (layer != ""):
-                            labMin += " ("+layer+")"
+            tree, valid = self._getHoverTree(xscale, yscale)
+            if not (tree is None):
+                ds, js = tree.query((xpt/xscale, ypt/yscale), k=min(HOVER_TIES, len(valid)))
+                ds = np.atleast_1d(ds)
+                js = np.atleast_1d(js)
+                # On (exact) ties, the first plotted point
+                distMin = ds[0]
+                j = valid[js[ds==distMin].min()]
+                (df, _, _, indxs, labelKey, layer) = self._plotted[self._hoverLayer[j]]
+                i = self._hoverIndx[j]
+                if (not (labelKey is None)) and (labelKey != ""):
+                    labMin = str(df.loc[indxs[i]][labelKey])
+                else:
+                    labMin = str(indxs[i])
+                if (not (layer is None)) and (layer != ""):
+                    labMin += " ("+layer+")"
                             
-            # Figure out where in the plot we are
-            (xmin, xmax) = self._ax.get_xlim()
-            (ymin, ymax) = self._ax.get_ylim()
-            xf = (event.xdata-xmin)/(xmax-xmin)
-            yf = (event.ydata-ymin)/(ymax-ymin)
-            halign = "right" if (xf > 0.5) else "left"
-        
             # Are we close enough? Distance depends on zoom!
-            if (distMin>10): 
-                if not (self._annotation is None):
-                    self._annotation.set_visible(False)
-            else:
+            if (distMin<=10): 
+                key = int(j)
+                
+                # Figure out where in the plot we are
+                (xmin, xmax) = self._ax.get_xlim()
+                xf = (event.xdata-xmin)/(xmax-xmin)
+                halign = ("left", "right")[int(xf > 0.5)]
+                
                 xpt += 10*xscale 
                 ypt += 10*yscale 
-                if not (self._annotation is None):
-                    self._annotation.set_text(labMin)
-                    self._annotation.set_x(xpt)
-                    self._annotation.set_y(ypt)
-                    self._annotation.set_horizontalalignment(halign)
-                else:
-                    self._annotation = self._ax.annotate(labMin, 
-                        xy=(xpt, ypt), xycoords='data',
-                        #xytext=(xpt + xoff, ypt+yoff), textcoords='data',
-                        horizontalalignment=halign,
-                        #arrowprops=dict(arrowstyle="simple",
-                        #connectionstyle="arc3,rad=-0.2"),
-                        bbox=dict(boxstyle="round", facecolor="w", 
-                        edgecolor="0.5", alpha=0.9)
-                )
-                self._annotation.set_visible(True)
-        elif not (self._annotation is None):
+        
+        if (key is None):
+            self.updateAnnotation(None)
+        else:
+            self.updateAnnotation(key, labMin, xpt, ypt, halign)
+
+    def updateAnnotation(self, key, text="", x=0, y=0, halign="left"):
+        '''
+        Show the hover annotation with 'text' at x,y (data coordinates),
+        for the point identified by 'key'. Hide it if 'key' is None.
+        If that point's annotation (or none) is on screen already, the
+        annotation is left where it is, and nothing is redrawn.
+        '''
+        if (key == self._annotationKey):
+            self._annotation.set_visible(key is not None)
+            return
+        if (key is None):
             self._annotation.set_visible(False)
+        else:
+            self._annotation.set_text(text)
+            self._annotation.xy = (x, y)
+            self._annotation.set_position((x, y))
+            self._annotation.set_horizontalalignment(halign)
+            self._annotation.set_visible(True)
             
-        # Force a redraw
-        self._fig.canvas.draw()
+        # Redraw (only the annotation)
+        self.drawAnnotation()
+        self._annotationKey = key
+
+    def _on_draw(self, _):
+        '''
+        Callback after a full draw: keep the rendered plot (without
+        the annotation) as background for annotation updates
+        '''
+        # A full draw wipes the (animated) annotation from the screen
+        self._annotationKey = None
+        if (self._fig.canvas.supports_blit):
+            self._background = self._fig.canvas.copy_from_bbox(self._fig.bbox)
+        
+    def drawAnnotation(self):
+        '''
+        Redraw the hover annotation on top of the saved background,
+        instead of redrawing the whole figure.
+        Falls back to a full draw if the canvas cannot do that.
+        '''
+        canvas = self._fig.canvas
+        if not (canvas.supports_blit):
+            self._annotation.set_animated(False)
+            canvas.draw()
+            self._annotation.set_animated(True)
+            return
+        if (self._background is None):
+            # Full draw, also saves the background (see _on_draw)
+            canvas.draw()
+            if (self._background is None):
+                return
+        canvas.restore_region(self._background)
+        if not (self._annotation is None) and self._annotation.get_visible():
+            self._ax.draw_artist(self._annotation)
+        canvas.blit(self._fig.bbox)
 
+    def _getHoverTree(self, xscale, yscale):
+        '''
+        Search tree for all plotted points, in screen-scaled coordinates.
+        Built on first use, and rebuilt only if the zoom (scale) changed.
+        Returns tree and indices of the (finite) points in it.
+        '''
+        cached = self._tree
+        if (cached is None or not np.isclose(cached[0], xscale, rtol=1e-3)
+                or not np.isclose(cached[1], yscale, rtol=1e-3)):
+            xs = self._hoverXs
+            ys = self._hoverYs
+            valid = np.flatnonzero(np.isfinite(xs) & np.isfinite(ys))
+            tree = None
+            if (len(valid)>0):
+                tree = cKDTree(np.column_stack((xs[valid]/xscale, ys[valid]/yscale)))
+            cached = (xscale, yscale, tree, valid)
+            self._tree = cached
+        return cached[2], cached[3]
+
+    def _resetInvTransData(self, _=None):
+        '''
+        Callback on zoom/resize: the cached inverse transform is outdated
+        '''
+        self._invTransData = None
+        
+    def getInvTransData(self, ia):
+        '''
+        Inverse of the data transform of axes ia (screen to data coordinates).
+        Cached for the plot axes, as inverting it on each mouse move is costly.
+        '''
+        if not (ia is self._ax):
+            return ia.transData.inverted()
+        if (self._invTransData is None):
+            self._invTransData = ia.transData.inverted()
+        return self._invTransData
+        
     def filterEvent(self, event):
         '''
         Filter an event. 
@@ -340,7 +502,7 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         ia = event.inaxes
         if not (ia is None):
             # Shifted coord to determine scale
-            xd1, yd1 = ia.transData.inverted().transform((event.x+1, event.y+1))
+            xd1, yd1 = self.getInvTransData(ia).transform((event.x+1, event.y+1))
             event.plot_xscale = abs(event.xdata - xd1)
             event.plot_yscale = abs(event.ydata - yd1)
             event.plot_scale = None
@@ -357,7 +519,22 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         Record plotted points (for hover callbacks)
         If no points recorded, no hover callbacks are generated.
         '''
-        if (self._plotted is None): self._plotted = list()
+        if (self._plotted is None):
+            self._plotted = list()
+            self._hoverXs = np.empty(0, dtype=np.float32)
+            self._hoverYs = np.empty(0, dtype=np.float32)
+            self._hoverLayer = np.empty(0, dtype=int)
+            self._hoverIndx = np.empty(0, dtype=int)
+        
+        # Points of all layers in flat arrays, with the layer they
+        # belong to and their position in that layer.
+        # Single precision is plenty for hovering (10 pixel tolerance)
+        n = len(xs)
+        self._hoverXs = np.concatenate((self._hoverXs, np.asarray(xs, dtype=np.float32)))
+        self._hoverYs = np.concatenate((self._hoverYs, np.asarray(zs, dtype=np.float32)))
+        self._hoverLayer = np.concatenate((self._hoverLayer, np.full(n, len(self._plotted))))
+        self._hoverIndx = np.concatenate((self._hoverIndx, np.arange(n)))
+        self._tree = None
         self._plotted.append((df, xs, zs, indxs, labelKey, layer))
 
     def callbacksConnect(self):
@@ -368,8 +545,11 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         if not (self._plotted is None):
             self._hovercall = self._fig.canvas.mpl_connect(
                 "motion_notify_event", self._on_hover)
+            self._drawcall = self._fig.canvas.mpl_connect(
+                "draw_event", self._on_draw)
         else:
             self._hovercall = None
+            self._drawcall = None
             
     def callbacksDisconnect(self):
         '''
@@ -378,6 +558,10 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         if not (self._hovercall is None):
             self._fig.canvas.mpl_disconnect(self._hovercall)
         self._hovercall = None
+        if not (self._drawcall is None):
+            self._fig.canvas.mpl_disconnect(self._drawcall)
+        self._drawcall = None
+        self._background = None
         if not (self._timer is None):
             self._timer.stop()
             self._timer = None
@@ -414,6 +598,10 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         In batch mode, write the output file.
         Can be overridden to extend behavior.
         '''
+        # Open the plot, if nothing was added to it
+        if (self._ax is None):     
+            self.openFigure()
+        
         # Callbacks for the three modes
         # (TODO: more elegantly?)        
         if not (self._inDialog is None):
@@ -426,6 +614,9 @@ class MatPlotWrapper(GW.GenPlotWrapper):
             # Connect callbacks for MPL-interactive
             self.callbacksConnect()
             
+        # Lines (before the legend is sized)
+        self._flushLines()
+        
         # Axis annotation?
         if (self._hideTickLabels):
             #self._ax.set_axis_off()
@@ -520,11 +711,14 @@ class MatPlotWrapper(GW.GenPlotWrapper):
                         closeCmd=self._closePlot, filterEvent = self.filterEvent)
         elif not (fileName is None):
             plt.ioff()
-            plt.savefig(fileName, dpi=600)
+            kwargs = dict()
+            if (fileName.lower().endswith(".png")):
+                kwargs["pil_kwargs"] = {"compress_level": PNG_COMPRESS_LEVEL}
+            self._fig.savefig(fileName, dpi=600, **kwargs)
             ML.LogMessage("File {:s} written".format(fileName))
             #plt.show()
             #plt.clf()
-            plt.close()
+            plt.close(self._fig)
             self.close()
         else:
             # Let matplotlib do the rest
@@ -578,18 +772,9 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         colors = GW.GenPlotWrapper.getColorScale(self, **kwargs)
         
         # Invert lookup axis order, and values from 0-1 (for matplotlib)
-        red = list()
-        green = list()
-        blue = list()
-        vals = list(colors.keys())
-        vals.sort()
-        sc = 255
-        for p in vals:
-            red.append((p,colors[p][0]/sc,colors[p][0]/sc))
-            green.append((p,colors[p][1]/sc,colors[p][1]/sc))
-            blue.append((p,colors[p][2]/sc,colors[p][2]/sc))
-            
-        colors={"red":red, "green": green, "blue": blue}
+        # (conversion is cached, only the lists are new)
+        red, green, blue = _segmentData(tuple(sorted(colors.items())))
+        colors={"red":list(red), "green": list(green), "blue": list(blue)}
         
         return colors
         
@@ -600,17 +785,23 @@ class MatPlotWrapper(GW.GenPlotWrapper):
         # Open the plot (if needed), ...
         if (self._ax is None):     
             self.openFigure()
-        ax = self._ax
         
-        # Values
-        ptsz = list(zip(*pts))
-        x = ptsz[0]
-        y = ptsz[1]
+        # Values, as one (n,2) array (no unzipping into tuples);
+        # malformed input fails here, rather than when shown
+        xy = np.asarray(pts, dtype=float).reshape(-1, 2)
         
         # Default label
         if (label is None):
             label="Line"
         
-        # Create the plot
-        ax.plot(x, y, label=label, color="black", scalex=useForZoom, scaley=useForZoom)
+        # Lines are drawn in one go (per label) when shown
+        self._pendingLines.setdefault(label, list()).append(xy)
+            
+    def _flushLines(self):
+        '''
+        Add the lines from addLine to the plot, as one collection per label
+        '''
+        for (label, lines) in self._pendingLines.items():
+            self._ax.add_collection(LineCollection(lines, colors="black", label=label))
+        self._pendingLines = dict()
 
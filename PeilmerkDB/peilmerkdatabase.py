@@ -3,7 +3,6 @@ Classes and functions to manage a database of peilmerken and
 (leveling) measurements
 '''
 import pickle
-import copy
 import datetime
 import numpy as np
 import pandas as pd
@@ -945,8 +944,9 @@ class PeilDataBase:
         else:
             tzOut = tzData
 
-        # Return a copy, so others can manipulate it without damaging the database
-        tzOut = copy.deepcopy(tzOut)
+        # Return a copy, so others can manipulate it without damaging the database.
+        # The tuples are immutable, so copying the lists suffices.
+        tzOut = {srvy: list(tzPairs) for srvy, tzPairs in tzOut.items()}
         
         # Reference shifts can be provided as dict[srvy][year] or dataframe, with index year, 
         # and columns DIFF_KEY and SURVEY_KEY.
@@ -1,7 +1,60 @@
 '''
 PlotLine class that can be used for intersection, and to plot on maps
 '''
+import functools
+import math
 import numpy as np
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _projectLoop(x, y, x0, y0, cs, ss, maxDist):
+    '''
+    As _project, as an explicit (single pass) loop
+    (for compilation with numba)
+    '''
+    n = x.shape[0]
+    out = np.empty(n)
+    xmin = 1e37
+    xmax = -1e37
+    for k in range(n):
+        dx = x[k]-x0
+        dy = y[k]-y0
+        xproj = cs*dx+ss*dy
+        xmin = min(xmin, xproj)
+        xmax = max(xmax, xproj)
+        out[k] = xproj if (abs(cs*dy-ss*dx)<maxDist) else np.nan
+    return out, xmin, xmax
+
+def _project(x, y, x0, y0, cs, ss, maxDist):
+    '''
+    Project points x,y onto the line through x0,y0 with direction cs,ss.
+    Returns projections (NaN if further than maxDist), and their min and max.
+    Numba is optional: without it, the vectorized numpy version is used.
+    '''
+    dx = x-x0
+    dy = y-y0
+    xproj = cs*dx+ss*dy
+    dist = np.abs(cs*dy-ss*dx)
+    xmin = 1e37
+    xmax = -1e37
+    if (len(xproj)>0):
+        xmin = min(xmin, float(xproj.min()))
+        xmax = max(xmax, float(xproj.max()))
+    return np.where(dist<maxDist, xproj, np.nan), xmin, xmax
+
+if (njit is not None):
+    _project = njit(cache=True)(_projectLoop)
+
+@functools.lru_cache(maxsize=512)
+def _cosSin(angleDeg):
+    '''
+    Cosine and sine of angle (in degrees).
+    Cached, as lines tend to be created for a few (grid) angles only.
+    '''
+    angleRad = angleDeg*math.pi/180
+    return math.cos(angleRad), math.sin(angleRad)
 
 class PlotLine:
     '''
@@ -11,9 +64,7 @@ class PlotLine:
         self._xy = xy
         self._angleDeg = angleDeg
     
-        angleRad = self._angleDeg*np.pi/180
-        self._cs = np.cos(angleRad)
-        self._ss = np.sin(angleRad)
+        self._cs, self._ss = _cosSin(self._angleDeg)
         
         self._xmin = None
         self._xmax = None
@@ -26,14 +77,16 @@ class PlotLine:
         return xproj, dist
     
     def project(self, xvalues, yvalues, maxDist):
-        out = []
-        self._xmin = 1e37
-        self._xmax = -1e37
-        for xy in zip(xvalues, yvalues):
-            xproj, dist = self.proj(xy)
-            self._xmin = min(self._xmin, xproj)
-            self._xmax = max(self._xmax, xproj)
-            out.append(xproj if dist<maxDist else np.nan)
+        '''
+        Project all points onto the line (as array).
+        Points further than maxDist from the line are NaN.
+        '''
+        x = np.asarray(xvalues, dtype=float)
+        y = np.asarray(yvalues, dtype=float)
+        out, xmin, xmax = _project(x, y, float(self._xy[0]), float(self._xy[1]),
+                                   self._cs, self._ss, float(maxDist))
+        self._xmin = xmin
+        self._xmax = xmax
         return out
         
     def getEndPoints(self):
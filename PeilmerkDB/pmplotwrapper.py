@@ -4,6 +4,8 @@ Height or difference vs. time for one or
 more peilmerken, on one or more surveys.
 Used by SubsAnalysis.
 '''
+import functools
+import numpy as np
 from . import messagelogger as ML
 from . import matplotwrapper as MPW
 from . import peilmerkdatabase as PM # For special keys MEDIAN, MERGE
@@ -12,6 +14,21 @@ from . import peilmerkdatabase as PM # For special keys MEDIAN, MERGE
 
 AUTO_ZKEY="auto"
 
+# Marker and line style for normal, merged and median series
+SERIES_STYLES = (("o", "solid"), ("s", ""), ("", "dashed"))
+
+@functools.lru_cache(maxsize=1024)
+def _seriesStyle(sval):
+    '''
+    Index in SERIES_STYLES for a series (key) value.
+    Cached, as the same survey names come back in every plot.
+    '''
+    if (PM.MEDIAN in sval):
+        return 2
+    if (PM.MERGE in sval):
+        return 1
+    return 0
+
 class PmPlotWrapper(MPW.MatPlotWrapper):
     '''
     Module that contains class to make peilmerk plots:
@@ -26,13 +43,19 @@ class PmPlotWrapper(MPW.MatPlotWrapper):
         # Cache the curves being displayed
         self._allSeriesKeys = dict()
         
-        # Let the base class know the x-axis label
+        # Points added, but not plotted yet (see addPoints)
+        self._pendingPoints = list()
+        
+        # Let the base class know the axis labels
+        # (y-axis label is the default, e.g. SubsAnalysis sets the unit)
         self.setXLabel("Date")
+        self.setYLabel("NAP [m]")
         
     def getDisplayedSeries(self, key):
         '''
         Get list of the displayed Series for 'key' (i.e. all peilmerken
-        plotted if key=PM.PEILMERK_KEY, or all surveys plotted if key=PM.SURVEY_KEY).
+        plotted if key=PM.PEILMERK_KEY, or all surveys plotted if key=PM.SURVEY_KEY),
+        over all calls to 'addPoints'.
         Gives 'KeyError' if no series are plotted for that key (i.e. if peilmerken are
         asked for, but the only variation between the series is survey).
 
@@ -65,11 +88,8 @@ class PmPlotWrapper(MPW.MatPlotWrapper):
         leads to a separate plot element.
         skeys could be peilmerk (so one plot element per peilmerk),
         survey name, or both.
+        The points are plotted when the plot is shown (all calls in one go).
         '''
-        # Open the plot (if needed), ...
-        if (self._ax is None):     
-            self.openFigure()
-        
         # Cannot do anything with empty df
         if (len(df)==0):
             ML.LogMessage("No points to plot")
@@ -87,79 +107,103 @@ class PmPlotWrapper(MPW.MatPlotWrapper):
         if isinstance(skeys, str):
             skeys=[skeys]
             
-        # We also need a copy of the list in reverse
-        skeys_r = skeys.copy()
-        skeys_r.reverse()
-
-        # Init admin
-        indxs = {}
-        srvys = {}
+        # Keep overall list globally
         for skey in skeys:
-            indxs[skey] = 0
-            srvys[skey] = []
-            
-            # Keep overall list globally
-            self._allSeriesKeys[skey] = set()
+            svals = df[skey].unique()
+            self._allSeriesKeys.setdefault(skey, set()).update(svals.tolist())
         
-        # Plot 1-by-1, loop over variable # of dimensions
-        keepGoing = True
-        while (keepGoing):
-            # Init admin for current cycle. We filter df2 as we move through the levels,
-            # and build up sname along the way
-            df2 = df
-            sname = ""
+        # Keep (a copy of) the columns needed for plotting
+        self._pendingPoints.append((df[[self.dkey, self.hkey]+skeys], skeys))
+
+    def _plotSeries(self, df, skeys):
+        '''
+        Plot the points of one addPoints call, one line per series.
+        Returns the number of series.
+        '''
+        # Plot order of each row's series (-1: not plotted, e.g. missing key)
+        rank = np.full(len(df), -1)
+        if (len(skeys)==1):
+            # Single key (the common case): series in order of first occurrence,
+            # which is how factorize numbers them
+            codes, svals = df[skeys[0]].factorize()
+            order = [(sval,) for sval in svals]
+            rank[:] = codes
+        else:
+            # Split into series in one pass
+            # (row positions per tuple of values of skeys).
+            # Only combinations that occur, also for categorical columns.
+            groups = dict()
+            for (svals, idx) in df.groupby(skeys, sort=False, observed=True).indices.items():
+                if not isinstance(svals, tuple):
+                    svals = (svals,)
+                groups[svals] = idx
             
-            # Select on all dimensions 1-by-1, start with the highest, then update the list
-            # on the lower, etc.
-            for skey in skeys:
-                # Don't unnecessarily refresh the list
-                if (len(srvys[skey])==0):
-                    srvys[skey] = list(df2[skey].unique())
+            # Plot 1-by-1. Order by first occurrence of the highest level,
+            # then (within that) of the next level, etc.
+            first = dict()
+            for (svals, idx) in groups.items():
+                for k in range(1, len(skeys)+1):
+                    first[svals[:k]] = min(first.get(svals[:k], idx[0]), idx[0])
+            order = sorted(groups, 
+                        key=lambda svals: [first[svals[:k]] for k in range(1, len(skeys)+1)])
+            for (i, svals) in enumerate(order):
+                rank[groups[svals]] = i
             
-                    # Keep overall list globally
-                    self._allSeriesKeys[skey] = self._allSeriesKeys[skey].union(srvys[skey])
-                #print(skey, indxs, srvys)
-                sval = srvys[skey][indxs[skey]]
-                df2 = df2[df2[skey]==sval]
-                sname += sval+", "
-            sname = sname[:-2]
+        # Put the rows of the series one after the other (in plot order),
+        # each series sorted on date (for its line). Then each series is 
+        # a contiguous slice of the plotted columns.
+        xs = df[self.dkey].to_numpy()
+        perm = np.lexsort((xs, rank))
+        perm = perm[rank[perm]>=0]
+        xs = xs[perm]
+        ys = df[self.hkey].to_numpy()[perm]
+        ends = np.cumsum(np.bincount(rank[perm], minlength=len(order)))
+        
+        for (i, svals) in enumerate(order):
+            start = ends[i-1] if (i>0) else 0
+            end = ends[i]
             
-            # Skip if no data
-            if (len(df2)>0):
-                # Special types
-                marker="o"
-                linestyle="solid"
-                if (PM.MEDIAN in sname):
-                    linestyle="dashed"
-                    marker=""
-                elif (PM.MERGE in sname):
-                    linestyle=""
-                    marker="s"
+            # Series name from all dimensions
+            sname = ", ".join(svals)
             
-                # Add to plot
-                df2.plot(ax=self._ax, marker=marker, ylabel="NAP [m]",
-                        x=self.dkey, y=self.hkey, label=sname,
-                        linewidth=1.0,  linestyle=linestyle)#, color=df.columns)
-                        
-                # Record the line (so we can later scale the legend)
-                self.addEntry()
-                        
-            # Move to next index, until we've covered everything.
-            # The lowest level moves first (hence use the reversed list).
-            keepGoing = False
-            for skey in skeys_r:
-                indxs[skey] += 1
-                if (indxs[skey] < len(srvys[skey])):
-                    keepGoing = True
-                    break
+            # Special types (median wins if in any dimension)
+            marker, linestyle = SERIES_STYLES[max(map(_seriesStyle, svals))]
+        
+            # Add to plot (directly, pandas' plot adds a lot of overhead per call)
+            self._ax.plot(xs[start:end], ys[start:end], marker=marker, label=sname,
+                    linewidth=1.0,  linestyle=linestyle)
+
+        return len(order)
+        
+    def _flushPoints(self):
+        '''
+        Plot the points from addPoints (all calls in one go)
+        '''
+        if (len(self._pendingPoints)==0):
+            return
             
-                # We're done at this level.
-                # Higher index will move, so list at current level needs to be refreshed
-                indxs[skey] = 0            
-                srvys[skey] = []
+        # Open the plot (if needed), now there is something to plot
+        if (self._ax is None):     
+            self.openFigure()
+        
+        numSeries = 0
+        for (df, skeys) in self._pendingPoints:
+            numSeries += self._plotSeries(df, skeys)
+        self._pendingPoints = list()
+
+        # Record the lines (so we can later scale the legend)
+        self.addEntries([None]*numSeries)
 
         #print("allSeriesKeys", self._allSeriesKeys)
         
+    def show(self, title=None, fileName=None):
+        '''
+        Show the plot, after plotting the points added.
+        Overridden from base class.
+        '''
+        self._flushPoints()
+        MPW.MatPlotWrapper.show(self, title=title, fileName=fileName)
+        
     def setTimePeriod(self, tmin, tmax):
         '''
         Fix time period on x axis. Equivalent to MPW.MatPlotWrapper.setXRange
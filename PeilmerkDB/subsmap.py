@@ -129,7 +129,9 @@ class SubsMapper:
             if (hgts[-1][0]>=t-MAP_TTOL_MAP and hgts[0][0]<=td0+MAP_TTOL_MAP):
                 xarr.append(x)
                 yarr.append(y)
-                dz=IP.Interpolate(hgts,td0)-IP.Interpolate(hgts,t)
+                ts, zs = np.array(hgts, dtype=float).T
+                z0, z1 = IP.InterpolateMany(ts, zs, (td0, t))
+                dz=z0-z1
                 zarr.append(dz)
                 i+=1
 
@@ -143,7 +145,8 @@ class SubsMapper:
 
             # Show points that were measured near this time as dots on the map
             if (len(srs)>0):
-                tc=IP.GetClosest(srs,t)[0]
+                sts, szs = np.array(srs, dtype=float).T
+                tc=IP.GetClosestArr(sts,szs,t)[0]
                 if (abs(tc-t)<MAP_TTOL_PEILMERK):
                     xcl.append(x)
                     ycl.append(y)
@@ -0,0 +1,29 @@
+'''
+Tests for FoliumWrapper point coloring
+'''
+import numpy as np
+import pandas as pd
+from PeilmerkDB import foliummapwrapper as FMW
+from PeilmerkDB import genplotwrapper as GW
+
+def _makeWrapper():
+    fow = FMW.FoliumWrapper("map", GW.GenPlotManager())
+    fow.addColormap("subs", -10, 0)
+    return fow
+
+def test_lookupColorsNaN():
+    fow = _makeWrapper()
+    colors = fow._lookupColors("subs", np.array([-10., np.nan, 0., np.inf]), "blue")
+    assert colors[1] == "blue"
+    assert colors[3] == "blue"
+    assert colors[0] == fow._lookupColors("subs", np.array([-10.]), "blue")[0]
+    assert colors[2] == fow._lookupColors("subs", np.array([0.]), "blue")[0]
+    assert colors[0] != "blue" and colors[2] != "blue"
+
+def test_addPointsNaN():
+    fow = _makeWrapper()
+    df = pd.DataFrame({fow.xkey: [155000., 155100.], fow.ykey: [463000., 463100.],
+                       "dz": [-5., np.nan]})
+    fow.addPoints(df, zKey="dz", color="gray")
+    payload = fow._markers["Points"].getPayload()
+    assert payload.count('"gray"') == 1